@@ -1,4 +1,4 @@
-from random import randint
+from random import randint, choice
 from socket import socket, AF_INET, SOCK_DGRAM
 from src.connection import (
     connection_except,
@@ -8,7 +8,10 @@ from src.connection import (
 )
 from src.state.user import UserStateMachine
 from src.input_read import InputRead
-from src.game import TicTacToe
+from src.game import TicTacToe, MAX_SIZE, valid_board
+from src.solver import Solver
+from src.perfect_play import PerfectPlay, WIN, LOSS, TIE
+from threading import Lock
 
 import sys
 import os
@@ -24,6 +27,11 @@ class Client:
         self.tls_port = args.tls_port
         self.tls_server_hostname = "server-ep2-mac352"
         self.listen_port = args.listen_port
+        self.tls_keep_alive = args.tls_keep_alive
+        self.presence_push = args.presence_push
+        self.relay = args.relay
+        self.board_size = args.board_size
+        self.board_k = args.row_length or args.board_size
 
         self.user_state = UserStateMachine()
         self.username = ""
@@ -31,11 +39,19 @@ class Client:
         self.default_connection = ClientConnectionHandler(
             self.ip_address, self.default_port
         )
+        self.default_connection.on("presence_update", self.__handle_presence_update)
+        self.default_connection.on("match_found", self.__handle_match_found)
+        self.default_connection.on("heartbeat", self.__handle_heartbeat)
+        self.default_connection.on("relay_invitation", self.__handle_relay_invitation)
+        self.default_connection.on("relay_refused", self.__handle_relay_refused)
+        self.default_connection.on("relay_game_init", self.__handle_relay_game_init)
+        self.default_connection.on("relay_move", self.__handle_relay_move)
+        self.default_connection.on("relay_game_end", self.__handle_relay_game_end)
 
         self.secure_connection = ClientConnectionHandler(
             self.ip_address,
             self.tls_port,
-            keep_alive=False,
+            keep_alive=self.tls_keep_alive,
             tls=True,
             tls_cert="src/server_ssl/server.crt",
             server_hostname=self.tls_server_hostname,
@@ -46,17 +62,24 @@ class Client:
 
         self.client_ip_address = _socket.getsockname()[0]
 
-        self.p2p_server = P2PServerEventHandler(
-            self.client_ip_address, self.listen_port
-        )
+        # Relayed games go through the server, no P2P listener is needed
+        self.p2p_server = None
+        if not self.relay:
+            self.p2p_server = P2PServerEventHandler(
+                self.client_ip_address, self.listen_port
+            )
 
-        self.p2p_server.on("invitation", self.__handle_invitation)
-        self.p2p_server.on("game_init", self.__handle_game_init)
-        self.p2p_server.on("game_move", self.__handle_game_move)
-        self.p2p_server.on("game_end", self.__handle_game_end)
-        self.p2p_server.start()
+            self.p2p_server.on("invitation", self.__handle_invitation)
+            self.p2p_server.on("game_init", self.__handle_game_init)
+            self.p2p_server.on("game_move", self.__handle_game_move)
+            self.p2p_server.on("game_end", self.__handle_game_end)
+            self.p2p_server.start()
 
         self.online_users = {}
+        self.presence_version = None
+        self.presence_backlog = []
+        self.presence_lock = Lock()
+        self.players_query = None
 
         self.commands = {
             "adduser": {
@@ -70,8 +93,12 @@ class Client:
             },
             "list": {"callback": self.__players, "state": [self.user_state.logged]},
             "leaders": {"callback": self.__leaders, "state": [self.user_state.logged]},
+            "history": {"callback": self.__history, "state": [self.user_state.logged]},
+            "replay": {"callback": self.__replay, "state": [self.user_state.logged]},
             "begin": {"callback": self.__new_game, "state": [self.user_state.logged]},
+            "queue": {"callback": self.__queue, "state": [self.user_state.logged]},
             "send": {"callback": self.__send, "state": [self.user_state.playing_game]},
+            "hint": {"callback": self.__hint, "state": [self.user_state.playing_game]},
             "end": {
                 "callback": self.__end_game,
                 "state": [
@@ -87,7 +114,21 @@ class Client:
         }
 
         self.game = None
+        self.game_id = None
+        # Keeps the oponent answer to a relay move from being applied before
+        # the move itself
+        self.relay_lock = Lock()
         self.p2p_connection = None
+        self.matched_user = None
+        self.bot_game = False
+        self.solver = None
+
+        # Generated with 'python3 -m src.perfect_play', the solver is used
+        # when it is missing
+        try:
+            self.perfect_play = PerfectPlay()
+        except (OSError, ValueError):
+            self.perfect_play = None
 
         signal.signal(signal.SIGINT, self.__handle_signal)
 
@@ -133,6 +174,8 @@ class Client:
 
         if response and response.get("status") == "OK":
             print("Usuário adicionado com sucesso.")
+        elif response and response.get("status") == "BUSY":
+            print("Servidor ocupado, tente novamente em instantes.")
         else:
             print("Nome de usuário indisponível, tente outro.")
 
@@ -155,6 +198,8 @@ class Client:
             self.username = params[0]
             self.user_state.login_success()
             self.__login_callback()
+        elif response.get("status") == "BUSY":
+            print("Servidor ocupado, tente novamente em instantes.")
         else:
             print("Falha ao efetuar login. Verifique suas credenciais.")
 
@@ -164,10 +209,14 @@ class Client:
                 "new_user_connection",
                 {
                     "username": self.username,
-                    "listen_port": self.listen_port,
+                    "listen_port": self.listen_port or 0,
                 },
             )
 
+            if self.presence_push:
+                response = self.default_connection.request("subscribe_presence")
+                self.__update_online_users(response)
+
         print("Login efetuado com sucesso.")
 
     def __passwd(self, params):
@@ -188,13 +237,26 @@ class Client:
 
         if response.get("status") == "OK":
             print("Senha atualizada com sucesso.")
+        elif response.get("status") == "BUSY":
+            print("Servidor ocupado, tente novamente em instantes.")
         else:
             print("Senha atual incorreta.")
 
     def __players(self, params):
+        if params and params[0] in ("idle", "all", "more"):
+            self.__players_page(params)
+            return
+
         with connection_except():
-            response = self.default_connection.request("list_players")
-        self.online_users = response.get("players")
+            response = self.default_connection.request(
+                "list_players",
+                (
+                    {}
+                    if self.presence_version is None
+                    else {"since_version": self.presence_version}
+                ),
+            )
+        self.__update_online_users(response)
 
         print("\nUSUÁRIOS ONLINE\n")
         for user, data in self.online_users.items():
@@ -204,9 +266,92 @@ class Client:
                 )
         print()
 
+    def __players_page(self, params):
+        if params[0] == "more":
+            if self.players_query is None or self.players_query.get("cursor") is None:
+                print("Não há mais usuários para listar.")
+                return
+            query = self.players_query
+        else:
+            query = {"limit": 20}
+            if params[0] == "idle":
+                query["state"] = "IDLE"
+            if len(params) > 1:
+                query["prefix"] = params[1]
+
+        with connection_except():
+            response = self.default_connection.request("list_players", query)
+
+        players = response.get("players", {})
+        self.players_query = {**query, "cursor": response.get("next_cursor")}
+        with self.presence_lock:
+            self.online_users.update(players)
+
+        print("\nUSUÁRIOS ONLINE\n")
+        for user, data in players.items():
+            if user != self.username:
+                print(
+                    f"  {user} - {'ACEITANDO PARTIDA' if data[2] == 'IDLE' else 'INDISPONÍVEL'}"
+                )
+        if response.get("next_cursor") is not None:
+            print("\n  Use 'list more' para ver a próxima página.")
+        print()
+
+    def __update_online_users(self, response):
+        with self.presence_lock:
+            if (players := response.get("players")) is not None:
+                self.online_users = players
+                self.presence_version = response.get("version")
+                # Pushes that arrived before the snapshot, the ones it already
+                # includes are skipped by their version
+                backlog, self.presence_backlog = self.presence_backlog, []
+                self.__apply_presence_changes(backlog)
+            else:
+                self.__apply_presence_changes(response.get("changes", []))
+
+    def __apply_presence_changes(self, changes):
+        for change in changes:
+            if (
+                self.presence_version is None
+                or change["version"] <= self.presence_version
+            ):
+                continue
+
+            # A change went missing, the next 'list' fetches a full snapshot
+            if change["version"] != self.presence_version + 1:
+                self.presence_version = None
+                return
+
+            if change["player"] is None:
+                self.online_users.pop(change["username"], None)
+            else:
+                self.online_users[change["username"]] = change["player"]
+            self.presence_version = change["version"]
+
+    def __handle_presence_update(self, request, connection):
+        with self.presence_lock:
+            if self.presence_version is None:
+                # Kept until a snapshot tells which of them are new
+                self.presence_backlog.extend(request.get("changes", []))
+            else:
+                self.__apply_presence_changes(request.get("changes", []))
+
     def __leaders(self, params):
+        if len(params) > 1:
+            print(
+                f"leaders aceita no máximo 1 argumento, no entanto, {len(params)} foram passados."
+            )
+            return
+
+        if params and params[0] == "me":
+            request = {"around": self.username, "limit": 10}
+        elif params and params[0].isnumeric():
+            request = {"offset": 0, "limit": int(params[0])}
+        else:
+            request = {"offset": 0, "limit": 10}
+
         with connection_except():
-            response = self.default_connection.request("leaderboard")
+            response = self.default_connection.request("leaderboard", request)
 
         print(
             "{:<12} {:<12} {:<12} {:<12} {:<12} {:<12}".format(
@@ -214,18 +359,89 @@ class Client:
             )
         )
 
-        for index, user in enumerate(response.get("leaderboard")):
-            if user != self.username:
-                print(
-                    "{:<12} {:<12} {:<12} {:<12} {:<12} {:<12}".format(
-                        index + 1,
-                        user.get("username"),
-                        user.get("wins"),
-                        user.get("ties"),
-                        user.get("loses"),
-                        user.get("points"),
-                    )
+        for user in response.get("leaderboard"):
+            print(
+                "{:<12} {:<12} {:<12} {:<12} {:<12} {:<12}".format(
+                    user.get("position"),
+                    user.get("username"),
+                    user.get("wins"),
+                    user.get("ties"),
+                    user.get("loses"),
+                    user.get("points"),
                 )
+            )
+
+    def __history(self, params):
+        if len(params) > 1:
+            print(
+                f"history aceita no máximo 1 argumento, no entanto, {len(params)} foram passados."
+            )
+            return
+
+        username = params[0] if params else self.username
+
+        with connection_except():
+            response = self.default_connection.request(
+                "game_history", {"username": username, "limit": 10}
+            )
+
+        if not response.get("games"):
+            print(f"Nenhuma partida de {username} encontrada.")
+            return
+
+        print(
+            "{:<12} {:<12} {:<12} {:<12} {:<12}".format(
+                "PARTIDA", "JOGADOR X", "JOGADOR O", "TABULEIRO", "VENCEDOR"
+            )
+        )
+
+        for game in response.get("games"):
+            print(
+                "{:<12} {:<12} {:<12} {:<12} {:<12}".format(
+                    game.get("game_id"),
+                    *game.get("players"),
+                    f"{game.get('size')}x{game.get('size')}",
+                    self.__replay_winner(game),
+                )
+            )
+
+    def __replay(self, params):
+        if len(params) != 1 or not params[0].isnumeric():
+            print("replay necessita do número da partida, veja o comando 'history'.")
+            return
+
+        with connection_except():
+            response = self.default_connection.request(
+                "game_replay", {"game_id": int(params[0])}
+            )
+
+        if response.get("status") != "OK":
+            print("Partida não encontrada.")
+            return
+
+        game = response.get("game")
+        players = game.get("players")
+        board = TicTacToe("X", "O", game.get("size"), game.get("k"))
+
+        for number, (row, col) in enumerate(response.get("moves")):
+            if number % 2 == 0:
+                board.play(row, col)
+            else:
+                board.update_oponent_move(row, col)
+
+            print(f"Jogada {number + 1}: {players[number % 2]} em {row} {col}")
+            print(board)
+
+        print(f"Vencedor: {self.__replay_winner(game)}")
+
+    def __replay_winner(self, game):
+        if game.get("end_status") is None:
+            return "em andamento"
+        if game.get("winner") == "tie":
+            return "empate"
+        if game.get("winner") == "None":
+            return "abandonada"
+        return game.get("winner")
 
     def __new_game(self, params):
         if len(params) != 1:
@@ -235,6 +451,10 @@ class Client:
             return
 
         oponent_user = params[0]
+        if oponent_user == "bot":
+            self.__start_bot_game()
+            return
+
         oponent_data = self.online_users.get(oponent_user)
 
         if oponent_user == self.username:
@@ -251,6 +471,10 @@ class Client:
 
                 return
 
+            if self.relay:
+                self.__relay_invite(oponent_user)
+                return
+
             with connection_except():
                 permission_response = self.default_connection.request(
                     "init_game_permission",
@@ -266,65 +490,273 @@ class Client:
 
                 return
 
-            self.p2p_connection = ClientConnectionHandler(
-                target_user_addr, target_user_port
+            self.__start_game(oponent_user, target_user_addr, target_user_port)
+        else:
+            print(
+                "Por favor, verifique se o usuário escolhido está realmente online utilizando o comando 'list'."
+            )
+
+    def __start_game(self, oponent_user, target_user_addr, target_user_port):
+        # The server already holds both players as WAITING, either through
+        # init_game_permission or because the matchmaking queue paired them
+        self.p2p_connection = ClientConnectionHandler(
+            target_user_addr, target_user_port
+        )
+        self.p2p_connection.on("game_move", self.__handle_game_move)
+        self.p2p_connection.on("game_end", self.__handle_game_end)
+
+        with connection_except():
+            response = self.p2p_connection.request(
+                "invitation",
+                {
+                    "username": self.username,
+                    "size": self.board_size,
+                    "k": self.board_k,
+                },
+            )
+
+        with connection_except():
+            self.default_connection.request(
+                "init_game",
+                {
+                    "users": [self.username, oponent_user],
+                    "invitation_status": response.get("status"),
+                },
             )
-            self.p2p_connection.on("game_move", self.__handle_game_move)
-            self.p2p_connection.on("game_end", self.__handle_game_end)
 
+        if response.get("status") == "ACCEPT":
+            self.user_state.game_init()
+            self.game_controller = True
+            self.oponent_user = oponent_user
+
+            first_player = randint(0, 1)
+            player_choice = None
+
+            if first_player == 0:
+                player_choice = self.__player_choice()
+                current_choice = "O" if player_choice == "X" else "X"
+                self.game = TicTacToe(
+                    player_choice, current_choice, self.board_size, self.board_k
+                )
             with connection_except():
                 response = self.p2p_connection.request(
-                    "invitation",
+                    "game_init",
                     {
-                        "username": self.username,
+                        "first_player": first_player,
+                        "player_choice": player_choice,
+                        "size": self.board_size,
+                        "k": self.board_k,
                     },
                 )
 
+            if first_player == 1:
+                player_choice = response.get("player_choice")
+                current_choice = "O" if player_choice == "X" else "X"
+                print(
+                    f"O oponente foi sorteado como primeiro jogador, você será o jogador {current_choice}."
+                )
+                self.game = TicTacToe(
+                    current_choice, player_choice, self.board_size, self.board_k
+                )
+                self.user_state.waiting()
+        else:
+            print(f"{oponent_user} recusou o seu convite para um novo jogo.")
+
+    def __start_bot_game(self):
+        # Single player game against perfect play, played locally and not
+        # reported to the server
+        self.user_state.game_init()
+        self.game_controller = None
+        self.bot_game = True
+        self.oponent_user = "bot"
+
+        if randint(0, 1) == 0:
+            player_choice = self.__player_choice()
+            current_choice = "O" if player_choice == "X" else "X"
+            self.game = TicTacToe(player_choice, current_choice)
+        else:
+            current_choice = choice("XO")
+            player_choice = "O" if current_choice == "X" else "X"
+            print(
+                f"O computador foi sorteado como primeiro jogador, você será o jogador {player_choice}."
+            )
+            self.game = TicTacToe(player_choice, current_choice)
+            self.__bot_move()
+
+    def __bot_move(self):
+        (row, col), _ = self.__perfect_move(
+            self.game.oponent_mask, self.game.player_mask
+        )
+        move_status = self.game.update_oponent_move(row, col)
+
+        print(self.game)
+        print()
+        return move_status
+
+    def __perfect_move(self, mover, other):
+        if self.perfect_play is not None:
+            return self.perfect_play.lookup(mover, other)
+
+        if self.solver is None:
+            self.solver = Solver()
+        outcome = {1: WIN, -1: LOSS, 0: TIE}[self.solver.outcome(mover, other)]
+        return self.solver.best_move(mover, other), outcome
+
+    def __hint(self, params):
+        if self.game.size != 3 or self.game.k != 3:
+            print("Dicas só estão disponíveis no tabuleiro 3x3.")
+            return
+
+        move, outcome = self.__perfect_move(
+            self.game.player_mask, self.game.oponent_mask
+        )
+        if outcome == WIN:
+            print(f"Jogue 'send {move[0]} {move[1]}', você pode vencer a partida.")
+        elif outcome == TIE:
+            print(f"Jogue 'send {move[0]} {move[1]}', o melhor resultado é o empate.")
+        else:
+            print(
+                f"Jogue 'send {move[0]} {move[1]}', mas o oponente pode vencer se não errar."
+            )
+
+    def __queue(self, params):
+        if params and params[0] == "leave":
             with connection_except():
-                self.default_connection.request(
-                    "init_game",
-                    {
-                        "users": [self.username, oponent_user],
-                        "invitation_status": response.get("status"),
-                    },
+                response = self.default_connection.request(
+                    "leave_queue", {"username": self.username}
                 )
 
-            if response.get("status") == "ACCEPT":
-                self.user_state.game_init()
-                self.game_controller = True
-                self.oponent_user = oponent_user
+            if response.get("status") == "OK":
+                print("Você saiu da fila de partidas.")
+            else:
+                print("Você não está na fila de partidas.")
+            return
 
-                first_player = randint(0, 1)
-                player_choice = None
+        with connection_except():
+            response = self.default_connection.request(
+                "join_queue", {"username": self.username}
+            )
 
-                if first_player == 0:
-                    player_choice = self.__player_choice()
-                    current_choice = "O" if player_choice == "X" else "X"
-                    self.game = TicTacToe(player_choice, current_choice)
-                with connection_except():
-                    response = self.p2p_connection.request(
-                        "game_init",
-                        {
-                            "first_player": first_player,
-                            "player_choice": player_choice,
-                        },
-                    )
+        if response.get("status") == "OK":
+            print(
+                "Procurando um oponente, você será avisado quando a partida for encontrada."
+            )
+        else:
+            print("Não foi possível entrar na fila de partidas no momento.")
 
-                if first_player == 1:
-                    player_choice = response.get("player_choice")
-                    current_choice = "O" if player_choice == "X" else "X"
-                    print(
-                        f"O oponente foi sorteado como primeiro jogador, você será o jogador {current_choice}."
-                    )
-                    self.game = TicTacToe(current_choice, player_choice)
-                    self.user_state.waiting()
+    def __handle_heartbeat(self, event, connection):
+        # Answering keeps the server from closing an idle connection
+        self.default_connection.request_async("heartbeat")
+
+    def __handle_match_found(self, event, connection):
+        oponent_user = event["opponent"]
+        target_user_addr, target_user_port = event["address"]
+
+        if event["controller"]:
+            print(f"\nPartida encontrada contra {oponent_user}!")
+            if self.relay:
+                self.__relay_invite(oponent_user)
             else:
-                print(f"{params[0]} recusou o seu convite para um novo jogo.")
+                self.__start_game(oponent_user, target_user_addr, target_user_port)
         else:
             print(
-                "Por favor, verifique se o usuário escolhido está realmente online utilizando o comando 'list'."
+                f"\nPartida encontrada contra {oponent_user}, aguardando o convite..."
+            )
+            self.matched_user = oponent_user
+
+    def __relay_invite(self, oponent_user):
+        with connection_except():
+            response = self.default_connection.request(
+                "relay_invite",
+                {
+                    "username": self.username,
+                    "opponent": oponent_user,
+                    "size": self.board_size,
+                    "k": self.board_k,
+                },
+            )
+
+        if response.get("status") == "OK":
+            print(f"Convite enviado para {oponent_user}, aguardando resposta...")
+        else:
+            print(
+                f"{oponent_user} se encontra indisponível no momento, por favor escolha outro jogador."
+            )
+
+    def __handle_relay_invitation(self, event, connection):
+        if event["username"] == self.matched_user:
+            self.matched_user = None
+            status = "ACCEPT"
+        elif self.bot_game:
+            status = "REFUSED"
+        else:
+            board = self.__board_name(event.get("size", 3), event.get("k", 3))
+            with self.input_non_blocking.block_input():
+                command = input(
+                    f"\nO usuário {event['username']} está querendo iniciar um novo jogo{board}, você aceita a partida? S/N\n"
+                ).strip()
+
+            status = "ACCEPT" if command.lower() == "s" else "REFUSED"
+
+        with connection_except():
+            self.default_connection.request(
+                "relay_answer",
+                {"game_id": event["game_id"], "invitation_status": status},
             )
 
+    def __handle_relay_refused(self, event, connection):
+        print(f"\n{event['username']} recusou o seu convite para um novo jogo.")
+
+    def __handle_relay_game_init(self, event, connection):
+        with self.input_non_blocking.block_input():
+            self.user_state.game_init()
+            self.game_controller = None
+            self.game_id = event["game_id"]
+            self.oponent_user = event["opponent"]
+
+            player_choice = event["mark"]
+            current_choice = "O" if player_choice == "X" else "X"
+            self.game = TicTacToe(
+                player_choice, current_choice, event.get("size", 3), event.get("k")
+            )
+
+            if event["first"]:
+                print(
+                    f"\nVocê foi sorteado como primeiro jogador contra {self.oponent_user}, você será o jogador {player_choice}."
+                )
+            else:
+                print(
+                    f"\nO oponente {self.oponent_user} foi sorteado como primeiro jogador, você será o jogador {player_choice}."
+                )
+                self.user_state.waiting()
+
+    def __handle_relay_move(self, event, connection):
+        with self.relay_lock, self.input_non_blocking.block_input():
+            row, col = event["move"]
+            move_status = self.game.update_oponent_move(int(row), int(col))
+
+            print(self.game)
+            print()
+            self.user_state.ready()
+
+            if move_status:
+                self.__finish_game(move_status)
+
+    def __handle_relay_game_end(self, event, connection):
+        with self.input_non_blocking.block_input():
+            if self.game_id != event["game_id"]:
+                print("\nO convite para a partida foi cancelado.")
+                return
+
+            if event.get("reason") != "timeout":
+                print("O oponente abandonou a partida.")
+            elif event["winner"] == self.username:
+                print("O tempo do oponente para jogar acabou, você venceu a partida.")
+            else:
+                print("O seu tempo para jogar acabou, você perdeu a partida.")
+            print()
+            self.__clean_user_state()
+
     def __player_choice(self):
         with self.input_non_blocking.block_input():
             print("\nVocê foi sorteado como primeiro jogador...")
@@ -335,6 +767,12 @@ class Client:
 
         return player.upper()
 
+    def __board_name(self, size, k):
+        # Games on the default board keep the original messages
+        if size == 3 and k == 3:
+            return ""
+        return f" {size}x{size} ({k} em linha)"
+
     def __send(self, params):
         if len(params) != 2:
             print(
@@ -345,7 +783,13 @@ class Client:
         row, column = params
 
         if not row.isnumeric() or not column.isnumeric():
-            print("send aceita apenas caracteres númericos entre 1 e 3.")
+            print(
+                f"send aceita apenas caracteres númericos entre 1 e {self.game.size}."
+            )
+            return
+
+        if self.game_id is not None:
+            self.__relay_send(row, column)
             return
 
         move_status = self.game.play(int(row), int(column))
@@ -363,7 +807,7 @@ class Client:
                             "move": [row, column],
                         },
                     )
-            else:
+            elif not self.bot_game:
                 self.p2p_server.emit(
                     json.dumps(
                         {
@@ -374,12 +818,42 @@ class Client:
                     ).encode("ascii")
                 )
 
+            if not move_status and self.bot_game:
+                move_status = self.__bot_move()
+
             if move_status:
                 self.user_state.ready()
                 self.__finish_game(move_status)
+            elif self.bot_game:
+                self.user_state.ready()
         elif move_status == "invalid":
             print("Jogada inválida, por favor tente novamente.")
 
+    def __relay_send(self, row, column):
+        # The server keeps the board of relay games, so the move is only
+        # applied here once the server accepts it
+        with self.relay_lock:
+            response = None
+            with connection_except():
+                response = self.default_connection.request(
+                    "relay_move", {"game_id": self.game_id, "move": [row, column]}
+                )
+
+            if response is None:
+                return
+            if response.get("status") != "OK":
+                print("Jogada inválida, por favor tente novamente.")
+                return
+
+            move_status = self.game.play(int(row), int(column))
+            print(self.game)
+            print()
+
+            if move_status:
+                self.__finish_game(move_status)
+            else:
+                self.user_state.waiting()
+
     def __finish_game(self, status):
         player_status = "win" if self.game.main_player() == status else "lose"
 
@@ -418,11 +892,13 @@ class Client:
             self.p2p_connection.close()
             self.p2p_connection = None
             self.game_controller = None
-        else:
+        elif self.p2p_server:
             self.p2p_server.clear_connections()
 
         self.game = None
+        self.game_id = None
         self.oponent_user = None
+        self.bot_game = False
 
         if self.user_state.current_state == self.user_state.waiting_game_instruction:
             self.user_state.ready()
@@ -438,6 +914,12 @@ class Client:
                 },
             )
         self.user_state.log_off()
+        self.matched_user = None
+
+        with self.presence_lock:
+            self.online_users = {}
+            self.presence_version = None
+            self.presence_backlog = []
 
         print("Logout efetuado com sucesso.")
 
@@ -448,7 +930,12 @@ class Client:
             if command.lower() == "n":
                 return
 
-            if self.game_controller:
+            if self.game_id is not None:
+                with connection_except():
+                    self.default_connection.request(
+                        "relay_leave", {"game_id": self.game_id}
+                    )
+            elif self.game_controller:
                 with connection_except():
                     self.default_connection.request(
                         "finish_game",
@@ -461,7 +948,7 @@ class Client:
 
                 with connection_except():
                     self.p2p_connection.request("game_end")
-            else:
+            elif not self.bot_game:
                 self.p2p_server.emit(
                     json.dumps(
                         {
@@ -481,14 +968,38 @@ class Client:
         if self.p2p_connection:
             self.p2p_connection.close()
 
-        self.p2p_server.stop_server()
+        if self.p2p_server:
+            self.p2p_server.stop_server()
         exit(0)
 
     @response_wrapper
     def __handle_invitation(self, request, response):
+        size = getattr(request, "size", 3)
+        k = getattr(request, "k", size)
+
+        # A board the peer cannot play, building a large one alone would
+        # stall the client
+        if not valid_board(size, k):
+            response.send("invitation", {"status": "REFUSED"})
+            return
+
+        # Players paired by the matchmaking queue already agreed to play
+        if request.username == self.matched_user:
+            self.matched_user = None
+            self.oponent_user = request.username
+            response.send("invitation", {"status": "ACCEPT"})
+            return
+
+        # The server still lists players of bot games as available
+        if self.bot_game:
+            response.send("invitation", {"status": "REFUSED"})
+            return
+
+        board = self.__board_name(size, k)
+
         with self.input_non_blocking.block_input():
             command = input(
-                f"\nO usuário {request.username} está querendo iniciar um novo jogo, você aceita a partida? S/N\n"
+                f"\nO usuário {request.username} está querendo iniciar um novo jogo{board}, você aceita a partida? S/N\n"
             ).strip()
 
             status = None
@@ -508,6 +1019,14 @@ class Client:
 
     @response_wrapper
     def __handle_game_init(self, request, response):
+        # Peers without board settings play the default 3x3 game
+        size = getattr(request, "size", 3)
+        k = getattr(request, "k", size)
+
+        if not valid_board(size, k):
+            response.send("game_init", {"status": "REFUSED"})
+            return
+
         with self.input_non_blocking.block_input():
             self.user_state.game_init()
             self.game_controller = False
@@ -520,12 +1039,12 @@ class Client:
                 print(
                     f"O oponente foi sorteado como primeiro jogador, você será o jogador {current_choice}."
                 )
-                self.game = TicTacToe(current_choice, player_choice)
+                self.game = TicTacToe(current_choice, player_choice, size, k)
                 self.user_state.waiting()
             elif first_player == 1:
                 player_choice = self.__player_choice()
                 current_choice = "O" if player_choice == "X" else "X"
-                self.game = TicTacToe(player_choice, current_choice)
+                self.game = TicTacToe(player_choice, current_choice, size, k)
 
             response.send("game_init", {"player_choice": player_choice})
 
@@ -600,18 +1119,56 @@ def main():
         help="secure server port, default is 8081",
         default=8081,
     )
+    parser.add_argument(
+        "-tlska",
+        "--tls-keep-alive",
+        action="store_true",
+        help="keep the secure connection open between requests instead of reconnecting",
+    )
+    parser.add_argument(
+        "-pp",
+        "--presence-push",
+        action="store_true",
+        help="receive online players changes from the server instead of only on 'list'",
+    )
+    parser.add_argument(
+        "-r",
+        "--relay",
+        action="store_true",
+        help="play games through the server instead of a direct connection to the opponent, no listen port is needed",
+    )
+    parser.add_argument(
+        "-bs",
+        "--board-size",
+        type=int,
+        help=f"size of the board of the games you invite to, up to {MAX_SIZE}, default is 3",
+        default=3,
+    )
+    parser.add_argument(
+        "-rl",
+        "--row-length",
+        type=int,
+        help="marks in a row needed to win the games you invite to, default is the board size",
+    )
 
     requiredNamed = parser.add_argument_group("required named arguments")
     requiredNamed.add_argument(
         "-lp",
         "--listen-port",
         type=int,
-        help="client port for P2P connections",
-        required=True,
+        help="client port for P2P connections, not needed with --relay",
     )
 
     args = parser.parse_args()
 
+    if args.listen_port is None and not args.relay:
+        parser.error("the following arguments are required: -lp/--listen-port")
+
+    if not valid_board(args.board_size, args.row_length or args.board_size):
+        parser.error(
+            f"the board size must be between 3 and {MAX_SIZE} and the row length between 3 and the board size"
+        )
+
     if args.ip_address is None:
         _socket = socket(AF_INET, SOCK_DGRAM)
         _socket.connect(("8.8.8.8", 1))
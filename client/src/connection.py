@@ -4,47 +4,56 @@ from socket import (
     SOCK_STREAM,
     SOL_SOCKET,
     SO_REUSEADDR,
+    SHUT_RDWR,
     create_connection,
     error as socket_error,
 )
 from contextlib import contextmanager
 from ssl import SSLContext, PROTOCOL_TLS_CLIENT
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, Condition
+from queue import Queue
+from traceback import print_exception
+from concurrent.futures import Future, InvalidStateError
+from itertools import count
+from heapq import heappush, heappop
+from time import monotonic
 from types import SimpleNamespace
+from src.protocol import PacketDecoder, ProtocolError, encode_packet
 import json
 
 
 class RequestHandler:
-    def __init__(self, request_id, request_body) -> None:
+    def __init__(self, request_id, request_body, timeout=None) -> None:
         self.__request_id = request_id
         self.__request_body = request_body
-        self.__ready = Event()
-        self.__response = None
+        self.__future = Future()
+        self.deadline = monotonic() + timeout if timeout is not None else None
 
     def request_id(self):
         return self.__request_id
 
     def get_request_body(self):
-        return json.dumps(
-            {"request_id": self.__request_id, **self.__request_body}
-        ).encode("ascii")
+        return encode_packet(
+            json.dumps({"request_id": self.__request_id, **self.__request_body}).encode(
+                "ascii"
+            )
+        )
 
     def set_response(self, response):
-        self.__response = response
-
-    def get_response(self):
-        response = dict(
-            (key, self.__response[key])
-            for key in self.__response
-            if key != "request_id"
-        )
-        return response
+        response = dict((key, response[key]) for key in response if key != "request_id")
+        try:
+            self.__future.set_result(response)
+        except InvalidStateError:
+            pass
 
-    def wait(self):
-        self.__ready.wait()
+    def set_error(self, error):
+        try:
+            self.__future.set_exception(error)
+        except InvalidStateError:
+            pass
 
-    def stop_wait(self):
-        self.__ready.set()
+    def future(self):
+        return self.__future
 
 
 class ClientConnectionHandler:
@@ -57,6 +66,7 @@ class ClientConnectionHandler:
         tls=False,
         tls_cert=None,
         server_hostname=None,
+        timeout=None,
     ):
         self.ip_address = ip_address
         self.port = port
@@ -64,49 +74,84 @@ class ClientConnectionHandler:
         self.tls = tls
         self.server_hostname = server_hostname
         self.bufflen = bufflen
+        self.timeout = timeout
 
         self.__keep_alive = keep_alive
 
+        # Reusing the context and the last session lets reconnects resume the
+        # TLS session instead of doing a full handshake
+        self.__tls_context = self.__create_tls_context() if tls else None
+        self.__tls_session = None
+        self.tls_sessions_reused = 0
+
         self.__request_count_lock = Lock()
-        self.__request_count = 1
+        self.__request_count = count(1)
 
         self.__requests_lock = Lock()
         self.__requests = {}
 
+        self.__timeouts_condition = Condition()
+        self.__timeouts = []
+        self.__timeouts_th = None
+
+        self.__send_lock = Lock()
+        self.__listener_lock = Lock()
+        self.__listener_th = None
+
         self.__connection_event = Event()
         self.__connection = None
+        # Requests made while the connection is coming up, sent once the
+        # server greets it
+        self.__pending = []
+        self.__listening = False
 
         self.__events = {}
         if self.__keep_alive:
+            self.__listening = True
             self.__run()
 
     def __run(self):
-        listener_th = Thread(target=self.__listen, daemon=True)
-        listener_th.start()
+        self.__listener_th = Thread(target=self.__listen, daemon=True)
+        self.__listener_th.start()
 
     def on(self, event, event_handler):
         self.__events[event] = event_handler
 
-    def request(self, packet_name, data={}, packet_type="request"):
-        request_body = {"packet_type": packet_type, "packet_name": packet_name, **data}
-
-        if not self.__keep_alive or (self.__keep_alive and not self.__connection):
-            self.__run()
-        self.__connection_event.wait()
+    def request(self, packet_name, data={}, packet_type="request", timeout=None):
+        return self.request_async(packet_name, data, packet_type, timeout).result()
 
-        request_obj = RequestHandler(self.__request_count, request_body)
+    def request_async(self, packet_name, data={}, packet_type="request", timeout=None):
+        request_body = {"packet_type": packet_type, "packet_name": packet_name, **data}
 
-        self.__add_request(request_obj)
+        # The timeout counts from here, connecting included
+        request_obj = RequestHandler(
+            self.__next_request_id(),
+            request_body,
+            timeout if timeout is not None else self.timeout,
+        )
 
-        try:
-            self.__connection.sendall(request_obj.get_request_body())
-        except socket_error:
-            raise socket_error
+        with self.__listener_lock:
+            if not self.__keep_alive and self.__listener_th is not None:
+                # A one-shot connection closes after its response, wait for it
+                # to finish so it does not tear down the next one
+                self.__listener_th.join()
+
+            # Under the send lock a listener is either running, and will send
+            # or fail the request, or done with all of its requests
+            with self.__send_lock:
+                self.__add_request(request_obj)
+                if self.__connection_event.is_set():
+                    self.__send_request(request_obj)
+                else:
+                    self.__pending.append(request_obj)
+                    if not self.__listening:
+                        self.__listening = True
+                        self.__run()
 
-        response = self.__get_response(request_obj.request_id())
-        self.__remove_request(request_obj.request_id())
+        if request_obj.deadline is not None:
+            self.__schedule_timeout(request_obj)
 
-        return response
+        return request_obj.future()
 
     def close(self):
         if self.__connection:
@@ -116,85 +161,170 @@ class ClientConnectionHandler:
         request_id = response.get("request_id")
         self.__set_response(request_id, response)
 
-    def __handle_event(self, event):
-        event_name = event.get("packet_name")
-
-        event_handler = self.__events.get(event_name)
-
-        event_handler_th = Thread(
-            target=event_handler, args=(event, self.__connection), daemon=True
-        )
-        event_handler_th.start()
+    def __dispatch(self, events):
+        # Events are handled one at a time in the order they arrived, so a
+        # handler never sees a push before the ones sent earlier
+        while (item := events.get()) is not None:
+            event, connection = item
+            if (event_handler := self.__events.get(event.get("packet_name"))) is None:
+                continue
 
-        return event_handler_th
+            try:
+                event_handler(event, connection)
+            except Exception as error:
+                print_exception(error)
 
     def __listen(self):
+        connection = None
         try:
-            self.__connection = create_connection((self.ip_address, self.port))
-        except socket_error as e:
-            print(e)
+            connection = create_connection((self.ip_address, self.port))
+            if self.tls:
+                connection = self.__tls_wrapper(connection)
+        except socket_error as error:
+            if connection is not None:
+                connection.close()
+            self.__fail_requests(error)
             return
 
-        event_handler_threads = []
-
-        if self.tls:
-            self.__connection = self.__tls_wrapper(self.__connection)
+        self.__connection = connection
 
-        try:
-            while data := self.__connection.recv(self.bufflen):
-                if data == b"OK":
-                    self.__connection_event.set()
-                    continue
+        events = Queue()
+        dispatcher_th = Thread(target=self.__dispatch, args=(events,), daemon=True)
+        dispatcher_th.start()
 
-                if data := json.loads(data or "{}"):
-                    packet_type = data.get("packet_type")
-                    if packet_type == "response":
-                        self.__handle_response(data)
-                    elif packet_type == "request":
-                        event_handler_th = self.__handle_event(data)
-                        event_handler_threads.append(event_handler_th)
+        decoder = PacketDecoder(self.bufflen)
 
-                if not self.__keep_alive:
+        try:
+            while (packets := decoder.receive(self.__connection)) is not None:
+                handled_response = False
+
+                for payload in packets:
+                    if payload == b"OK":
+                        self.__send_pending()
+                        continue
+
+                    if data := json.loads(payload or "{}"):
+                        packet_type = data.get("packet_type")
+                        if packet_type == "response":
+                            self.__handle_response(data)
+                            handled_response = True
+                        elif packet_type == "request":
+                            events.put((data, self.__connection))
+
+                if not self.__keep_alive and handled_response:
                     break
 
-        except socket_error as e:
+        except (socket_error, ProtocolError) as e:
             pass
 
-        for thead in event_handler_threads:
-            thead.join()
+        events.put(None)
+        dispatcher_th.join()
 
-        self.__connection_event.clear()
         if self.__connection:
+            if self.tls and self.__connection.session is not None:
+                self.__tls_session = self.__connection.session
             self.__connection.close()
         self.__connection = None
+        self.__fail_requests()
 
-    def __get_response(self, request_id):
-        if (request := self.__requests.get(request_id)) is not None:
-            request.wait()
-            return request.get_response()
+    def __next_request_id(self):
+        with self.__request_count_lock:
+            return next(self.__request_count)
 
     def __set_response(self, request_id, response):
-        if (request := self.__requests.get(request_id)) is not None:
+        if (request := self.__remove_request(request_id)) is not None:
             request.set_response(response)
-            request.stop_wait()
 
     def __remove_request(self, request_id):
         with self.__requests_lock:
-            self.__requests.pop(request_id)
+            return self.__requests.pop(request_id, None)
 
     def __add_request(self, request_obj):
         with self.__requests_lock:
             self.__requests[request_obj.request_id()] = request_obj
-        with self.__request_count_lock:
-            self.__request_count += 1
 
-    def __tls_wrapper(self, socket):
+    def __send_request(self, request_obj):
+        # Called holding the send lock
+        try:
+            self.__connection.sendall(request_obj.get_request_body())
+        except (socket_error, AttributeError):
+            self.__remove_request(request_obj.request_id())
+            request_obj.set_error(
+                socket_error("Connection closed before the request was sent")
+            )
+
+    def __send_pending(self):
+        with self.__send_lock:
+            self.__connection_event.set()
+            pending, self.__pending = self.__pending, []
+
+            for request_obj in pending:
+                # Skips the ones that timed out while connecting
+                if not request_obj.future().done():
+                    self.__send_request(request_obj)
+
+    def __fail_requests(self, error=None):
+        # The listener is done, requests made from now on start another one
+        with self.__send_lock:
+            self.__connection_event.clear()
+            self.__listening = False
+            self.__pending = []
+            with self.__requests_lock:
+                requests, self.__requests = self.__requests, {}
+
+        for request in requests.values():
+            request.set_error(error or socket_error("Connection closed"))
+
+    def __schedule_timeout(self, request_obj):
+        with self.__timeouts_condition:
+            heappush(self.__timeouts, (request_obj.deadline, request_obj.request_id()))
+
+            if self.__timeouts_th is None:
+                self.__timeouts_th = Thread(target=self.__watch_timeouts, daemon=True)
+                self.__timeouts_th.start()
+
+            self.__timeouts_condition.notify()
+
+    def __watch_timeouts(self):
+        with self.__timeouts_condition:
+            while True:
+                if not self.__timeouts:
+                    self.__timeouts_condition.wait()
+                    continue
+
+                deadline, request_id = self.__timeouts[0]
+                if (remaining := deadline - monotonic()) > 0:
+                    self.__timeouts_condition.wait(remaining)
+                    continue
+
+                heappop(self.__timeouts)
+                if (request := self.__remove_request(request_id)) is not None:
+                    request.set_error(TimeoutError(f"Request {request_id} timed out"))
+
+                    # A one-shot connection only ends with its response, the
+                    # next request would wait for it forever
+                    if not self.__keep_alive:
+                        self.__abort()
+
+    def __abort(self):
+        # Unlike close, wakes up the listener blocked reading the socket
+        if (connection := self.__connection) is not None:
+            try:
+                connection.shutdown(SHUT_RDWR)
+            except socket_error:
+                pass
+
+    def __create_tls_context(self):
         tls_context = SSLContext(PROTOCOL_TLS_CLIENT)
         tls_context.load_verify_locations(self.tls_cert)
+        return tls_context
 
-        connection = tls_context.wrap_socket(
-            socket, server_hostname=self.server_hostname
+    def __tls_wrapper(self, socket):
+        connection = self.__tls_context.wrap_socket(
+            socket, server_hostname=self.server_hostname, session=self.__tls_session
         )
+        if connection.session_reused:
+            self.tls_sessions_reused += 1
         return connection
 
 
@@ -219,13 +349,21 @@ class P2PServerEventHandler(Thread):
     def emit(self, payload):
         connection_errors = []
         if self.__is_running:
+            packet = encode_packet(payload)
+
+            # Sent outside of the lock, a peer that is slow to read must not
+            # keep new connections from being registered
             with self.__connections_lock:
-                for address, connection_info in self.__connections.items():
-                    connection, _ = connection_info
-                    try:
-                        connection.sendall(payload)
-                    except ConnectionResetError:
-                        connection_errors.append(address)
+                connections = [
+                    (address, connection)
+                    for address, (connection, _) in self.__connections.items()
+                ]
+
+            for address, connection in connections:
+                try:
+                    connection.sendall(packet)
+                except OSError:
+                    connection_errors.append(address)
         return connection_errors
 
     def run(self):
@@ -255,23 +393,27 @@ class P2PServerEventHandler(Thread):
         self.__is_running = False
 
     def __handle_connection(self, connection, address):
-        connection.sendall(b"OK")
+        decoder = PacketDecoder(self.bufflen)
+        connection.sendall(encode_packet(b"OK"))
         try:
             while self.__is_running:
-                payload = connection.recv(self.bufflen)
+                packets = decoder.receive(connection)
 
-                if payload:
-                    data = json.loads(payload)
-                    event_type = data.get("packet_name")
+                if packets is not None:
+                    for payload in packets:
+                        data = json.loads(payload)
+                        event_type = data.get("packet_name")
 
-                    with self.__events_lock:
-                        self.__events.get(event_type, lambda *_: _)(data, connection)
+                        with self.__events_lock:
+                            self.__events.get(event_type, lambda *_: _)(
+                                data, connection
+                            )
                 else:
                     with self.__connections_lock:
                         if address in self.__connections:
                             self.__connections.pop(address)
                     break
-        except socket_error:
+        except (socket_error, ProtocolError):
             pass
 
 
@@ -290,7 +432,7 @@ def response_wrapper(handler):
             if request_id:
                 payload.update({"request_id": request_id})
 
-            connection.sendall(json.dumps(payload).encode("ascii"))
+            connection.sendall(encode_packet(json.dumps(payload).encode("ascii")))
 
         send_obj = SimpleNamespace(send=send)
 
@@ -1,22 +1,72 @@
-from collections import Counter
+from functools import lru_cache
+
+# Boards larger than this do not fit a terminal
+MAX_SIZE = 19
+
+
+def valid_board(size, k):
+    return type(size) is int and type(k) is int and 3 <= k <= size <= MAX_SIZE
+
+
+@lru_cache(maxsize=None)
+def square_lines(size, k):
+    # Square (row, col) of the board is bit row * size + col of a player's
+    # mask. For every square, the masks of the k-long runs going through it
+    # in each of the four directions: a move can only complete one of these,
+    # so checking it costs at most 4k mask comparisons whatever the size.
+    lines = [[] for _ in range(size * size)]
+
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_row = row + d_row * (k - 1)
+                end_col = col + d_col * (k - 1)
+                if not (0 <= end_row < size and 0 <= end_col < size):
+                    continue
+
+                squares = [(row + d_row * i) * size + col + d_col * i for i in range(k)]
+                mask = sum(1 << square for square in squares)
+                for square in squares:
+                    lines[square].append(mask)
+
+    return tuple(tuple(square) for square in lines)
 
 
 class TicTacToe:
-    def __init__(self, player, oponent) -> None:
+    # A size x size board where k marks in a row win, 3x3 and 3 by default.
+    # The board is one bit mask per player, so placing a move and checking
+    # for a winner are a few integer operations.
+    __slots__ = (
+        "player",
+        "oponent",
+        "size",
+        "k",
+        "winner",
+        "moves_count",
+        "player_mask",
+        "oponent_mask",
+        "__lines",
+    )
+
+    def __init__(self, player, oponent, size=3, k=None) -> None:
+        self.size = size
+        self.k = k or size
+        self.__lines = square_lines(self.size, self.k)
         self.restart(player, oponent)
 
     def restart(self, player, oponent):
-        self.board = self.__create_board()
         self.player = player
         self.oponent = oponent
         self.winner = None
         self.moves_count = 0
+        self.player_mask = 0
+        self.oponent_mask = 0
 
     def play(self, row, col):
-        return self.__insert_move(row, col, self.player)
+        return self.__insert_move(row, col, True)
 
     def update_oponent_move(self, row, col):
-        return self.__insert_move(row, col, self.oponent)
+        return self.__insert_move(row, col, False)
 
     def get_winner(self):
         return self.winner
@@ -24,79 +74,50 @@ class TicTacToe:
     def main_player(self):
         return self.player
 
-    def __create_board(self):
-        return [["" for j in range(3)] for i in range(3)]
-
-    def __get_main_diagonal(self):
-        return [self.board[i][i] for i in range(len(self.board))]
-
-    def __get_secondary_diagonal(self):
-        return [self.board[i][len(self.board) - i - 1] for i in range(len(self.board))]
-
-    def __check_for_winner(self, counter):
-        highest_score = next(iter(counter.most_common(1)), None)
-        if highest_score and highest_score[0] in (self.player, self.oponent):
-            if highest_score[1] == 3:
-                return highest_score[0]
-
-        return None
-
-    def __insert_move(self, row, col, player):
-        if row not in range(1, 4) or col not in range(1, 4):
+    def __insert_move(self, row, col, is_player):
+        if row not in range(1, self.size + 1) or col not in range(1, self.size + 1):
             return "invalid"
 
-        row, col = row - 1, col - 1
+        square = (row - 1) * self.size + col - 1
+        bit = 1 << square
 
-        if not self.winner and self.moves_count < 9 and not self.board[row][col]:
-            self.moves_count += 1
-            self.board[row][col] = player
-        else:
+        if self.winner or (self.player_mask | self.oponent_mask) & bit:
             return "invalid"
 
-        # Check for winner in main diagonal
-        if row == col:
-            main_diagonal = Counter(self.__get_main_diagonal())
-            if winner := self.__check_for_winner(main_diagonal):
-                self.winner = winner
-                return winner
-
-        # Check for winner in secondary diagonal
-        if (row, col) in [(1, 1), (2, 0), (0, 2)]:
-            secondary_diagonal = Counter(self.__get_secondary_diagonal())
-            if winner := self.__check_for_winner(secondary_diagonal):
-                self.winner = winner
-                return winner
-
-        # Check for winner in rows and columns from (row, col)
-        n = len(self.board)
-        _column = Counter()
-        _row = Counter()
-
-        for i in range(n):
-            _column.update(self.board[row][i % n])
-            _row.update(self.board[i % n][col])
+        self.moves_count += 1
+        if is_player:
+            self.player_mask |= bit
+            mask, mark = self.player_mask, self.player
+        else:
+            self.oponent_mask |= bit
+            mask, mark = self.oponent_mask, self.oponent
 
-        if winner := self.__check_for_winner(_column):
-            self.winner = winner
-            return winner
-        if winner := self.__check_for_winner(_row):
-            self.winner = winner
-            return winner
+        for line in self.__lines[square]:
+            if mask & line == line:
+                self.winner = mark
+                return mark
 
         # Check for tie
-        if self.moves_count == 9:
+        if self.moves_count == self.size * self.size:
             self.winner = "tie"
             return self.winner
 
+    def __mark(self, square):
+        if self.player_mask >> square & 1:
+            return self.player
+        if self.oponent_mask >> square & 1:
+            return self.oponent
+        return ""
+
     def __str__(self):
-        n = len(self.board)
-        row = "{}    {:<2} |  {:<2} |  {:<2}\n"
-        sep = "    ---------------\n"
+        n = self.size
         string = "TABULEIRO:\n"
-        string += "     {:<2}    {:<2}    {:<2}\n\n".format(1, 2, 3)
+        string += "     " + "    ".join(f"{j + 1:<2}" for j in range(n)) + "\n\n"
 
         for i in range(n):
-            string += row.format(i + 1, *[val for val in self.board[i]])
-            string += sep if i < n - 1 else ""
+            marks = [f"{self.__mark(i * n + j):<2}" for j in range(n)]
+            string += f"{i + 1:<5}" + " |  ".join(marks) + "\n"
+            if i < n - 1:
+                string += "    " + "-----" * n + "\n"
 
         return string
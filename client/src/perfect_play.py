@@ -0,0 +1,102 @@
+from mmap import mmap, ACCESS_READ
+from src.solver import Solver, SIZE, SQUARES, FULL, LINES
+
+# Every 3x3 position as seen by the player to move, one byte each, indexed in
+# base 3: square s contributes 3 ** s times 1 for a mark of the player to move
+# and 2 for a mark of its oponent.
+#
+# The low nibble of a byte is the square of the best move, NO_MOVE when the
+# game is over. The next two bits are the outcome with perfect play for the
+# player to move. Positions that cannot happen in a game are all zero.
+TABLE_PATH = "src/perfect_play.bin"
+TABLE_SIZE = 3**SQUARES
+
+NO_MOVE = 0xF
+UNKNOWN, WIN, LOSS, TIE = 0, 1, 2, 3
+
+# Base 3 value of every mask, so an index is two lookups
+TERNARY = tuple(
+    sum(3**square for square in range(SQUARES) if mask >> square & 1)
+    for mask in range(FULL + 1)
+)
+ALL_LINES = frozenset(line for lines in LINES for line in lines)
+
+
+def index(mover, other):
+    return TERNARY[mover] + 2 * TERNARY[other]
+
+
+def has_line(mask):
+    return any(mask & line == line for line in ALL_LINES)
+
+
+def generate(path=TABLE_PATH):
+    # Walks every position reachable from the empty board and asks the solver
+    # for each of them. The solver shares its work between the 8 symmetric
+    # versions of a position, the table keeps all of them so a lookup does
+    # not have to canonicalise the board.
+    solver = Solver()
+    table = bytearray(TABLE_SIZE)
+    pending = [(0, 0)]
+    reached = 0
+
+    while pending:
+        mover, other = pending.pop()
+        position = index(mover, other)
+        if table[position]:
+            continue
+
+        reached += 1
+        if has_line(other):
+            table[position] = LOSS << 4 | NO_MOVE
+            continue
+        if mover | other == FULL:
+            table[position] = TIE << 4 | NO_MOVE
+            continue
+
+        value, moves = solver.best_squares(mover, other)
+        outcome = WIN if value > 0 else LOSS if value < 0 else TIE
+        table[position] = outcome << 4 | moves[0]
+
+        free = FULL & ~(mover | other)
+        for square in range(SQUARES):
+            if free >> square & 1:
+                pending.append((other, mover | 1 << square))
+
+    with open(path, "wb") as table_file:
+        table_file.write(table)
+
+    return reached
+
+
+class PerfectPlay:
+    # Read only view of the generated table. The file is mapped instead of
+    # read, so opening it costs nothing and the pages are shared by every
+    # client running on the machine.
+
+    def __init__(self, path=TABLE_PATH):
+        with open(path, "rb") as table_file:
+            self.__table = mmap(table_file.fileno(), 0, access=ACCESS_READ)
+
+        if len(self.__table) != TABLE_SIZE:
+            self.__table.close()
+            raise ValueError(f"{path} is not a perfect play table")
+
+    def lookup(self, mover, other):
+        # The best (row, col) for the player to move, None when the game is
+        # over, and the outcome with perfect play
+        entry = self.__table[index(mover, other)]
+        square, outcome = entry & 0xF, entry >> 4
+
+        if square == NO_MOVE or outcome == UNKNOWN:
+            return None, outcome
+
+        row, col = divmod(square, SIZE)
+        return (row + 1, col + 1), outcome
+
+    def close(self):
+        self.__table.close()
+
+
+if __name__ == "__main__":
+    print(f"{generate()} positions written to {TABLE_PATH}")
@@ -0,0 +1,148 @@
+from random import choice
+from src.game import square_lines
+
+# Exhaustive search is only practical on the classic board
+SIZE = 3
+SQUARES = SIZE * SIZE
+FULL = (1 << SQUARES) - 1
+LINES = square_lines(SIZE, SIZE)
+
+# Center first, then corners, then edges: the strongest moves are tried first
+# so alpha-beta cuts the other branches sooner
+ORDER = (4, 0, 2, 6, 8, 1, 3, 5, 7)
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+def symmetry_tables():
+    # The 8 rotations and reflections of the board, each one as a lookup
+    # table from a mask to the mask of the transformed board
+    maps = []
+    for reflect in (False, True):
+        for turns in range(4):
+            square_map = []
+            for square in range(SQUARES):
+                row, col = divmod(square, SIZE)
+                if reflect:
+                    col = SIZE - 1 - col
+                for _ in range(turns):
+                    row, col = col, SIZE - 1 - row
+                square_map.append(row * SIZE + col)
+            maps.append(square_map)
+
+    return tuple(
+        tuple(
+            sum(
+                1 << square_map[square]
+                for square in range(SQUARES)
+                if mask >> square & 1
+            )
+            for mask in range(FULL + 1)
+        )
+        for square_map in maps
+    )
+
+
+class Solver:
+    # Perfect play for the 3x3 board through negamax with alpha-beta pruning.
+    # Positions are kept in a transposition table filled lazily, keyed on the
+    # smallest of the 8 symmetric versions of the board so equivalent
+    # positions are only searched once. The whole game has a few thousand
+    # positions, so one solver can be shared by every game of the client.
+    #
+    # Scores are from the point of view of the player to move: a win counts
+    # the squares still free when it happens, so faster wins are preferred
+    # and losses are delayed, and a tie is 0.
+
+    def __init__(self):
+        self.__symmetries = symmetry_tables()
+        self.__table = {}
+
+    def __len__(self):
+        return len(self.__table)
+
+    def best_move(self, mover, other):
+        # mover and other are the masks of the player to move and of its
+        # oponent. Returns the (row, col) of one of the best moves, chosen at
+        # random among equally good ones.
+        _, moves = self.best_squares(mover, other)
+        if not moves:
+            return None
+
+        row, col = divmod(choice(moves), SIZE)
+        return row + 1, col + 1
+
+    def best_squares(self, mover, other):
+        # The score of the position and every square reaching it, in the
+        # order they were searched
+        free = FULL & ~(mover | other)
+        best, moves = None, []
+
+        for square in ORDER:
+            if not free >> square & 1:
+                continue
+
+            value = self.__move_value(
+                mover, other, free, square, -SQUARES - 1, SQUARES + 1
+            )
+            if best is None or value > best:
+                best, moves = value, [square]
+            elif value == best:
+                moves.append(square)
+
+        return best, moves
+
+    def outcome(self, mover, other):
+        # 1 if the player to move wins with perfect play, -1 if it loses, 0
+        # for a tie
+        value = self.__negamax(mover, other, -SQUARES - 1, SQUARES + 1)
+        return (value > 0) - (value < 0)
+
+    def __move_value(self, mover, other, free, square, alpha, beta):
+        played = mover | 1 << square
+        for line in LINES[square]:
+            if played & line == line:
+                return free.bit_count()
+
+        return -self.__negamax(other, played, -beta, -alpha)
+
+    def __negamax(self, mover, other, alpha, beta):
+        free = FULL & ~(mover | other)
+        if not free:
+            return 0
+
+        key = self.__key(mover, other)
+        if (entry := self.__table.get(key)) is not None:
+            value, bound = entry
+            if bound == EXACT:
+                return value
+            if bound == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        start = alpha
+        best = -SQUARES - 1
+        for square in ORDER:
+            if not free >> square & 1:
+                continue
+
+            best = max(best, self.__move_value(mover, other, free, square, alpha, beta))
+            alpha = max(alpha, best)
+            if alpha >= beta:
+                break
+
+        if best <= start:
+            self.__table[key] = (best, UPPER)
+        elif best >= beta:
+            self.__table[key] = (best, LOWER)
+        else:
+            self.__table[key] = (best, EXACT)
+        return best
+
+    def __key(self, mover, other):
+        return min(
+            table[mover] << SQUARES | table[other] for table in self.__symmetries
+        )
@@ -1,46 +1,145 @@
-from threading import Thread, Lock, Timer
+from threading import RLock
+from multiprocessing import Process
 from socket import socket, AF_INET, SOCK_DGRAM
-from src.auth import hash_password, check_password
+from src.auth import AuthWorkerPool, AuthBusyError
 from src.domain.user import User
+from src.domain.game import check_game_status
 from src.db import Storage
-from src.connection import ServerEventHandler, set_interval, response_wrapper
+from src.batch_writer import BatchWriter
+from src.leaderboard import Leaderboard, SQLLeaderboard
+from src.user_cache import UserCache
+from src.presence import PresenceStore
+from src.matchmaking import MatchmakingQueue
+from src.game_table import GameTable
+from src.move_recorder import MoveRecorder
+from src.game import valid_board
+from src.scheduler import Scheduler
+from src.coordinator import start_coordinator, connect_coordinator
+from src.connection import (
+    ServerEventHandler,
+    AsyncServerEventHandler,
+    response_wrapper,
+    push,
+    broadcast,
+)
+from datetime import datetime
+from time import monotonic
 
 import sqlite3
 import argparse
+import os
 import json
 import signal
 
 
 class Server:
-    def __init__(self, args):
+    def __init__(self, args, presence=None, first_game_id=None, game_id_step=1):
         self.default_port = args.port
         self.tls_port = args.tls_port
-        self.db = Storage()
-        self.logged_users = {}
-        self.db_lock = Lock()
-        self.logged_users_lock = Lock()
+        self.db = Storage(
+            mode=args.db_mode,
+            cache_size=args.db_cache_size,
+            mmap_size=args.db_mmap_size * 1024 * 1024,
+            readers=args.db_readers,
+        )
+        self.users = UserCache(self.db, args.user_cache_size, args.user_cache_ttl)
+        if presence is None:
+            self.logged_users = PresenceStore(on_change=self.__push_presence)
+            self.users_lock = self.logged_users.lock
+        else:
+            # Shared with the other worker processes through the coordinator,
+            # changes made by any of them are polled and pushed from here
+            self.logged_users = presence
+            self.users_lock = RLock()
+            self.presence_seen, _ = presence.snapshot()
+        self.presence_subscribers = {}
+        self.user_connections = {}
+        self.connection_users = {}
+        self.matchmaking = MatchmakingQueue(args.match_band)
+        self.pairings = {}
+        self.p2p_games = {}
+        if first_game_id is None:
+            first_game_id = self.db.get_last_game_id() + 1
+        self.games = GameTable(first_game_id, game_id_step)
+        if args.leaderboard == "sql":
+            self.leaderboard = SQLLeaderboard(self.db)
+        else:
+            self.leaderboard = Leaderboard()
+            self.leaderboard.load(self.db.get_all_users())
         self.ip_address = args.ip_address
+        self.engine = args.engine
+        self.auth_pool = AuthWorkerPool(args.auth_workers, args.auth_queue)
+        self.audit_log = BatchWriter(
+            self.__flush_logs, args.log_batch_size, args.log_flush_interval
+        )
+        self.history = MoveRecorder(
+            self.db, args.log_batch_size, args.log_flush_interval
+        )
+        self.workers = args.workers
+        self.max_in_flight = args.max_in_flight
+        self.outbox_limit = args.outbox_limit * 1024
+        self.slow_consumer = args.slow_consumer
+        self.reuse_port = presence is not None
+        self.presence_poll_interval = args.presence_poll_interval
+        self.heartbeat_interval = args.heartbeat_interval
+        self.idle_timeout = args.idle_timeout
+        self.move_timeout = args.move_timeout
+        self.scheduler = Scheduler()
 
     def run(self):
+        event_handler = (
+            AsyncServerEventHandler if self.engine == "async" else ServerEventHandler
+        )
 
-        self.connection_handler = ServerEventHandler(self.ip_address, self.default_port)
-        self.secure_connection_handler = ServerEventHandler(
+        self.connection_handler = event_handler(
+            self.ip_address,
+            self.default_port,
+            max_workers=self.workers,
+            max_in_flight=self.max_in_flight,
+            outbox_limit=self.outbox_limit,
+            slow_consumer=self.slow_consumer,
+            reuse_port=self.reuse_port,
+        )
+        self.secure_connection_handler = event_handler(
             self.ip_address,
             self.tls_port,
             bufflen=1024,
             tls=True,
             tls_cert="src/server_ssl/server.crt",
             tls_key="src/server_ssl/server.key",
+            max_workers=self.workers,
+            max_in_flight=self.max_in_flight,
+            reuse_port=self.reuse_port,
         )
 
-        with self.db_lock:
-            self.db.insert_log("server_started", {"status": "OK"})
+        self.audit_log.start()
+        self.history.start()
+        self.__log("server_started", {"status": "OK"})
 
         print(
             f"Servidor está escutando no ip {self.ip_address} nas portas {self.default_port} e {self.tls_port} (para conexões TLS)"
         )
 
-        set_interval(self.__heartbeat, 60)
+        self.scheduler.every(self.heartbeat_interval, self.__heartbeat)
+        if self.idle_timeout:
+            self.scheduler.every(self.heartbeat_interval, self.__reap_idle)
+        if self.move_timeout:
+            self.scheduler.every(
+                min(self.heartbeat_interval, self.move_timeout),
+                self.__expire_relay_games,
+            )
+        if self.reuse_port:
+            self.scheduler.every(self.presence_poll_interval, self.__poll_presence)
+            self.scheduler.every(60.0, self.leaderboard.refresh_total)
+        self.scheduler.start()
+
+        signal.signal(signal.SIGINT, self.__handle_signal)
+        signal.signal(signal.SIGTERM, self.__handle_signal)
+
+        # Handlers run concurrently, each one declares the locks of the shared
+        # state it touches. Storage does its own locking, so the database is
+        # not part of it.
+        users = self.users_lock
 
         self.secure_connection_handler.on("adduser", self.__add_user)
         self.secure_connection_handler.on("login", self.__login)
@@ -50,57 +149,279 @@ class Server:
 
         self.secure_connection_handler.start()
 
-        self.connection_handler.on("new_user_connection", self.__new_user_connection)
-        self.connection_handler.on("list_players", self.__list_players)
+        self.connection_handler.on(
+            "new_user_connection", self.__new_user_connection, [users]
+        )
+        self.connection_handler.on("list_players", self.__list_players, [users])
         self.connection_handler.on("leaderboard", self.__leaderboard)
-        self.connection_handler.on("logout", self.__logout)
-        self.connection_handler.on("init_game_permission", self.__init_game_permission)
-        self.connection_handler.on("init_game", self.__init_game)
-        self.connection_handler.on("finish_game", self.__finish_game)
+        self.connection_handler.on("game_history", self.__game_history)
+        self.connection_handler.on("game_replay", self.__game_replay)
+        self.connection_handler.on("logout", self.__logout, [users])
+        self.connection_handler.on(
+            "init_game_permission", self.__init_game_permission, [users]
+        )
+        self.connection_handler.on("init_game", self.__init_game, [users])
+        self.connection_handler.on("finish_game", self.__finish_game, [users])
+        self.connection_handler.on(
+            "subscribe_presence", self.__subscribe_presence, [users]
+        )
+        self.connection_handler.on("join_queue", self.__join_queue, [users])
+        self.connection_handler.on("leave_queue", self.__leave_queue, [users])
+        self.connection_handler.on("relay_invite", self.__relay_invite, [users])
+        self.connection_handler.on("relay_answer", self.__relay_answer, [users])
+        self.connection_handler.on("relay_move", self.__relay_move, [users])
+        self.connection_handler.on("relay_leave", self.__relay_leave, [users])
         self.connection_handler.on("connection", self.__connection)
+        self.connection_handler.on("disconnection", self.__user_disconnection, [users])
+        self.connection_handler.on("server_stats", self.__server_stats)
+        self.connection_handler.on("heartbeat", self.__heartbeat_reply)
         self.connection_handler.start()
 
+        # Handlers run on worker pools that are shut down once the main thread
+        # exits, so keep it alive for as long as the handlers are serving.
+        self.secure_connection_handler.join()
+        self.connection_handler.join()
+
     @response_wrapper
     def __list_players(self, request, response):
+        since_version = getattr(request, "since_version", None)
+        state = getattr(request, "state", None)
+        prefix = getattr(request, "prefix", None)
+        cursor = getattr(request, "cursor", None)
+        limit = getattr(request, "limit", None)
+
+        if state or prefix or cursor or limit is not None:
+            limit = self.__bounded(limit, 50, 1, 500)
+            if limit is None or any(
+                field is not None and type(field) is not str
+                for field in (state, prefix, cursor)
+            ):
+                response.send(
+                    "list_players", {"status": "FAIL", "error": "Invalid query"}
+                )
+                return
+
+            version, players, next_cursor = self.logged_users.query(
+                state, prefix, cursor, limit
+            )
+            response.send(
+                "list_players",
+                {
+                    "status": "OK",
+                    "version": version,
+                    "players": players,
+                    "next_cursor": next_cursor,
+                },
+            )
+            return
+
+        if since_version is not None:
+            if type(since_version) is not int:
+                response.send(
+                    "list_players", {"status": "FAIL", "error": "Invalid version"}
+                )
+                return
+
+            version, changes = self.logged_users.changes_since(since_version)
+            if changes is not None:
+                response.send(
+                    "list_players",
+                    {"status": "OK", "version": version, "changes": changes},
+                )
+                return
+
+        version, players = self.logged_users.snapshot()
         response.send(
             "list_players",
             {
                 "status": "OK",
-                "players": self.logged_users,
+                "version": version,
+                "players": players,
             },
         )
 
+    def __bounded(self, value, default, low, high):
+        # Numbers of a request come from the client as they are, None when
+        # they are not integers
+        if value is None:
+            return default
+        if type(value) is not int:
+            return None
+        return min(max(value, low), high)
+
+    @response_wrapper
+    def __subscribe_presence(self, request, response):
+        # Registered while holding the presence lock, so no change can slip in
+        # between the snapshot and the first pushed delta
+        self.presence_subscribers[response.peername] = response.connection
+
+        version, players = self.logged_users.snapshot()
+        response.send(
+            "subscribe_presence",
+            {"status": "OK", "version": version, "players": players},
+        )
+
+    def __user_disconnection(self, request, connection):
+        address = connection.getpeername()
+        self.presence_subscribers.pop(address, None)
+
+        if (username := self.connection_users.pop(address, None)) is not None:
+            self.__leave(username)
+
+            # The client is gone without logging out, drop it from the list
+            # of online players
+            if self.logged_users.remove(username):
+                self.__log("disconnection", {"ip": address[0], "username": username})
+
+    def __leave(self, username):
+        # The player logged out or disconnected, whatever they were doing with
+        # other players ends here
+        self.user_connections.pop(username, None)
+        self.matchmaking.leave(username)
+
+        if (opponent := self.__unpair(username)) is not None:
+            self.logged_users.transition([opponent], "WAITING", "IDLE")
+
+        # Without this player the direct game can no longer be reported
+        if (opponent := self.p2p_games.pop(username, None)) is not None:
+            self.p2p_games.pop(opponent, None)
+            self.logged_users.transition([opponent], "PLAYING", "IDLE")
+
+        if (game := self.games.of(username)) is not None:
+            self.__abandon_relay_game(game, username)
+
+    def __push_presence(self, change):
+        self.__push_presence_changes([change])
+
+    def __poll_presence(self):
+        with self.users_lock:
+            version, changes = self.logged_users.changes_since(
+                self.presence_seen, False
+            )
+            self.presence_seen = version
+
+            # When the history no longer reaches that far, subscribers notice
+            # the gap in the versions and fetch a snapshot
+            if changes:
+                self.__push_presence_changes(changes)
+
+    def __push_presence_changes(self, changes):
+        for connection in broadcast(
+            list(self.presence_subscribers.values()),
+            "presence_update",
+            {"changes": changes},
+        ):
+            self.presence_subscribers.pop(connection.getpeername(), None)
+
     @response_wrapper
     def __leaderboard(self, request, response):
-        users = self.db.get_all_users()
-        users_list = list(
-            map(
-                lambda user: {
-                    "username": user[0],
-                    "wins": user[1],
-                    "ties": user[3],
-                    "loses": user[2],
-                    "points": 2 * user[1] + user[3],
-                },
-                users,
+        offset = self.__bounded(getattr(request, "offset", None), 0, 0, float("inf"))
+        limit = getattr(request, "limit", None)
+        around = getattr(request, "around", None)
+        page_size = self.__bounded(limit, 10, 1, 500)
+
+        if offset is None or page_size is None:
+            response.send("leaderboard", {"status": "FAIL", "error": "Invalid page"})
+            return
+
+        if around:
+            leaderboard, total = self.leaderboard.around(around, page_size)
+        elif limit is None:
+            # The whole leaderboard, as older clients expect
+            leaderboard, total = self.leaderboard.page(offset)
+        else:
+            leaderboard, total = self.leaderboard.page(offset, page_size)
+
+        response.send(
+            "leaderboard", {"status": "OK", "leaderboard": leaderboard, "total": total}
+        )
+
+    @response_wrapper
+    def __game_history(self, request, response):
+        username = getattr(request, "username", None)
+        limit = self.__bounded(getattr(request, "limit", None), 10, 1, 100)
+
+        if type(username) is not str or limit is None:
+            response.send(
+                "game_history", {"status": "FAIL", "error": "Invalid request"}
             )
+            return
+
+        games = self.db.get_player_games(username, limit)
+
+        response.send(
+            "game_history",
+            {"status": "OK", "games": [self.__game_summary(game) for game in games]},
+        )
+
+    @response_wrapper
+    def __game_replay(self, request, response):
+        # Moves reach the database in batches, a game that just ended may
+        # take a moment to show up
+        game_id = getattr(request, "game_id", None)
+        game = self.db.get_game(game_id) if type(game_id) is int else None
+        if game is None:
+            response.send("game_replay", {"status": "FAIL", "error": "Unknown game"})
+            return
+
+        response.send(
+            "game_replay",
+            {
+                "status": "OK",
+                "game": self.__game_summary(game),
+                "moves": [
+                    [row, col] for row, col, _ in self.db.get_game_moves(game[0])
+                ],
+            },
         )
-        leaderboard = sorted(users_list, key=lambda user: user["points"], reverse=True)
 
-        response.send("leaderboard", {"status": "OK", "leaderboard": list(leaderboard)})
+    def __game_summary(self, game):
+        game_id, player_one, player_two, size, k, started_at, _, end_status, winner = (
+            game
+        )
+        return {
+            "game_id": game_id,
+            "players": [player_one, player_two],
+            "size": size,
+            "k": k,
+            "started_at": started_at,
+            "end_status": end_status,
+            "winner": winner,
+        }
+
+    @response_wrapper
+    def __server_stats(self, request, response):
+        response.send(
+            "server_stats",
+            {
+                "status": "OK",
+                "user_cache": self.users.stats(),
+                "tls_sessions": self.secure_connection_handler.session_stats(),
+            },
+        )
 
     @response_wrapper
     def __change_password(self, request, response):
         username = request.username
         current_password = request.current_password
         new_password = request.new_password
-        user = self.db.get_user(username)
+        user = self.users.get_user(username)
 
-        if user and check_password(current_password.encode("ascii"), user.password):
-            hashed_password = hash_password(new_password.encode("ascii"))
+        try:
+            is_valid = user and self.auth_pool.check_password(
+                current_password.encode("ascii"), user.password
+            )
+            if is_valid:
+                hashed_password = self.auth_pool.hash_password(
+                    new_password.encode("ascii")
+                )
+        except AuthBusyError:
+            response.send("password_change", self.__busy_response())
+            return
 
-            with self.db_lock:
-                self.db.change_password(username, hashed_password)
+        if is_valid:
+            self.db.change_password(username, hashed_password)
+            self.users.invalidate(username)
 
             response.send(
                 "password_change",
@@ -120,10 +441,16 @@ class Server:
     @response_wrapper
     def __add_user(self, request, response):
         username, password = request.username, request.password
-        hashed_password = hash_password(password.encode("ascii"))
         try:
-            with self.db_lock:
-                self.db.insert_user(User(username, hashed_password))
+            hashed_password = self.auth_pool.hash_password(password.encode("ascii"))
+        except AuthBusyError:
+            response.send("add_user", self.__busy_response())
+            return
+
+        try:
+            self.db.insert_user(User(username, hashed_password))
+            self.users.invalidate(username)
+            self.leaderboard.add_user(username)
             response.send("add_user", {"status": "OK"})
         except sqlite3.IntegrityError:
             response.send(
@@ -137,25 +464,31 @@ class Server:
     @response_wrapper
     def __login(self, request, response):
         username, password = request.username, request.password
-        user = self.db.get_user(username)
+        user = self.users.get_user(username)
 
-        if user and check_password(password.encode("ascii"), user.password):
-            with self.db_lock:
-                self.db.insert_log(
-                    "login",
-                    {"status": "OK", "ip": response.peername[0], "username": username},
-                )
+        try:
+            is_valid = user and self.auth_pool.check_password(
+                password.encode("ascii"), user.password
+            )
+        except AuthBusyError:
+            response.send("login", self.__busy_response())
+            return
+
+        if is_valid:
+            self.__log(
+                "login",
+                {"status": "OK", "ip": response.peername[0], "username": username},
+            )
             response.send("login", {"status": "OK"})
         else:
-            with self.db_lock:
-                self.db.insert_log(
-                    "login",
-                    {
-                        "status": "FAIL",
-                        "ip": response.peername[0],
-                        "username": username,
-                    },
-                )
+            self.__log(
+                "login",
+                {
+                    "status": "FAIL",
+                    "ip": response.peername[0],
+                    "username": username,
+                },
+            )
             response.send(
                 "login",
                 {
@@ -170,8 +503,9 @@ class Server:
         client_listen_port = request.listen_port
         addr = response.peername
 
-        with self.logged_users_lock:
-            self.logged_users[username] = [addr[0], client_listen_port, "IDLE"]
+        self.logged_users.add(username, addr[0], client_listen_port)
+        self.user_connections[username] = response.connection
+        self.connection_users[addr] = username
 
         response.send(
             "new_user_connection",
@@ -182,12 +516,14 @@ class Server:
 
     @response_wrapper
     def __logout(self, request, response):
-        username = request.username
         ip, _ = response.peername
-        with self.logged_users_lock, self.db_lock:
-            if username in self.logged_users:
-                self.logged_users.pop(username)
-                self.db.insert_log("logout", {"ip": ip})
+        if (username := self.connection_users.pop(response.peername, None)) is None:
+            response.send("logout", {"status": "FAIL", "error": "Not logged in"})
+            return
+
+        self.__leave(username)
+        if self.logged_users.remove(username):
+            self.__log("logout", {"ip": ip})
         response.send(
             "logout",
             {
@@ -199,44 +535,375 @@ class Server:
     def __init_game_permission(self, request, response):
         player_one, player_two = request.users
 
-        with self.logged_users_lock:
-            player_one_data = self.logged_users.get(player_one)
-            player_two_data = self.logged_users.get(player_two)
+        if (
+            self.connection_users.get(response.peername) not in request.users
+            or player_one == player_two
+        ):
+            response.send("init_game", {"status": "FAIL"})
+            return
 
-            if (
-                player_one_data
-                and player_one_data[2] == "IDLE"
-                and player_two_data
-                and player_two_data[2] == "IDLE"
-            ):
-                response.send("init_game", {"status": "OK"})
-                self.logged_users[player_one][2] = "WAITING"
-                self.logged_users[player_two][2] = "WAITING"
-            else:
-                response.send("init_game", {"status": "FAIL"})
+        if self.logged_users.transition([player_one, player_two], "IDLE", "WAITING"):
+            self.__pair(player_one, player_two)
+            response.send("init_game", {"status": "OK"})
+            self.matchmaking.leave(player_one)
+            self.matchmaking.leave(player_two)
+        else:
+            response.send("init_game", {"status": "FAIL"})
+
+    @response_wrapper
+    def __join_queue(self, request, response):
+        username = self.connection_users.get(response.peername)
+        player = self.logged_users.get(username)
+
+        if not player or player[2] != "IDLE":
+            response.send(
+                "join_queue",
+                {"status": "FAIL", "error": "Player is not available to play"},
+            )
+            return
+
+        points = self.leaderboard.points(username) or 0
+        response.send("join_queue", {"status": "OK"})
+
+        # A waiting player whose connection is gone is dropped and the next
+        # one is tried
+        while (opponent := self.matchmaking.join(username, points)) is not None:
+            if self.__match(opponent, username):
+                break
+
+    @response_wrapper
+    def __leave_queue(self, request, response):
+        username = self.connection_users.get(response.peername)
+        if username is not None and self.matchmaking.leave(username):
+            response.send("leave_queue", {"status": "OK"})
+        else:
+            response.send(
+                "leave_queue", {"status": "FAIL", "error": "Player is not queued"}
+            )
+
+    def __match(self, waiting, joined):
+        # Both players move to WAITING at once and only if they are still
+        # IDLE, so nobody can invite them in between, not even from another
+        # worker process. The player who just joined drives the game, the
+        # other one waits for its invitation.
+        if not self.logged_users.transition([waiting, joined], "IDLE", "WAITING"):
+            if (player := self.logged_users.get(joined)) is None or player[2] != "IDLE":
+                self.__requeue(waiting)
+                return True
+            return False
+
+        self.__pair(waiting, joined)
+        waiting_data = self.logged_users.get(waiting)
+        joined_data = self.logged_users.get(joined)
+
+        try:
+            push(
+                self.user_connections[waiting],
+                "match_found",
+                {"opponent": joined, "address": joined_data[:2], "controller": False},
+            )
+        except (KeyError, OSError):
+            self.__unpair(waiting)
+            self.logged_users.transition([waiting, joined], "WAITING", "IDLE")
+            return False
+
+        try:
+            push(
+                self.user_connections[joined],
+                "match_found",
+                {"opponent": waiting, "address": waiting_data[:2], "controller": True},
+            )
+        except (KeyError, OSError):
+            self.__unpair(waiting)
+            self.logged_users.transition([waiting, joined], "WAITING", "IDLE")
+            self.__requeue(waiting)
+
+        return True
+
+    def __pair(self, player_one, player_two):
+        # Players moved to WAITING by the matchmaking queue or by
+        # init_game_permission, until the controller starts their game
+        since = monotonic()
+        self.pairings[player_one] = (player_two, since)
+        self.pairings[player_two] = (player_one, since)
+
+    def __unpair(self, username):
+        if (pairing := self.pairings.pop(username, None)) is None:
+            return None
+
+        opponent = pairing[0]
+        if self.pairings.get(opponent, (None,))[0] == username:
+            del self.pairings[opponent]
+        return opponent
+
+    def __requeue(self, username):
+        points = self.leaderboard.points(username) or 0
+        if (opponent := self.matchmaking.join(username, points)) is not None:
+            self.__match(opponent, username)
+
+    @response_wrapper
+    def __relay_invite(self, request, response):
+        username = self.connection_users.get(response.peername)
+        opponent = getattr(request, "opponent", None)
+        size = getattr(request, "size", 3)
+        k = getattr(request, "k", size)
+
+        if username is None or type(opponent) is not str or opponent == username:
+            response.send(
+                "relay_invite", {"status": "FAIL", "error": "Invalid invitation"}
+            )
+            return
+
+        if not valid_board(size, k):
+            response.send(
+                "relay_invite", {"status": "FAIL", "error": "Invalid board size"}
+            )
+            return
+
+        if self.pairings.get(username, (None,))[0] == opponent:
+            # Paired by the matchmaking queue, both are WAITING already
+            self.__unpair(username)
+            available = opponent in self.user_connections
+            if not available:
+                self.logged_users.transition([username, opponent], "WAITING", "IDLE")
+        else:
+            available = (
+                opponent in self.user_connections
+                and self.logged_users.transition(
+                    [username, opponent], "IDLE", "WAITING"
+                )
+            )
+
+        if not available:
+            response.send(
+                "relay_invite",
+                {"status": "FAIL", "error": "Opponent is not available to play"},
+            )
+            return
+
+        game = self.games.create((username, opponent), size, k)
+        try:
+            push(
+                self.user_connections[opponent],
+                "relay_invitation",
+                {"game_id": game.id, "username": username, "size": size, "k": k},
+            )
+        except OSError:
+            self.games.remove(game)
+            self.logged_users.transition([username, opponent], "WAITING", "IDLE")
+            response.send(
+                "relay_invite",
+                {"status": "FAIL", "error": "Opponent is not available to play"},
+            )
+            return
+
+        self.matchmaking.leave(username)
+        self.matchmaking.leave(opponent)
+        response.send("relay_invite", {"status": "OK", "game_id": game.id})
+
+    @response_wrapper
+    def __relay_answer(self, request, response):
+        game = self.__relay_game(request)
+        username = self.connection_users.get(response.peername)
+
+        if game is None or game.started or username != game.players[1]:
+            response.send("relay_answer", {"status": "FAIL", "error": "Unknown game"})
+            return
+
+        response.send("relay_answer", {"status": "OK"})
+
+        if getattr(request, "invitation_status", None) != "ACCEPT":
+            self.games.remove(game)
+            self.logged_users.transition(game.players, "WAITING", "IDLE")
+            self.__push_player(
+                game.players[0],
+                "relay_refused",
+                {"game_id": game.id, "username": username},
+            )
+            return
+
+        self.games.start(game)
+        self.history.game_started(game)
+        self.logged_users.transition(game.players, "WAITING", "PLAYING")
+        self.__log(
+            "new_game",
+            {
+                "ip_player_one": self.__ip(game.players[0]),
+                "username_player_one": game.players[0],
+                "ip_player_two": self.__ip(game.players[1]),
+                "username_player_two": game.players[1],
+            },
+        )
+
+        for player in game.players:
+            self.__push_player(
+                player,
+                "relay_game_init",
+                {
+                    "game_id": game.id,
+                    "opponent": game.opponent(player),
+                    "mark": game.mark(player),
+                    "first": player == game.players[0],
+                    "size": game.board.size,
+                    "k": game.board.k,
+                },
+            )
+
+    @response_wrapper
+    def __relay_move(self, request, response):
+        game = self.__relay_game(request)
+        username = self.connection_users.get(response.peername)
+        try:
+            row, col = getattr(request, "move", None)
+            move = int(row), int(col)
+        except (TypeError, ValueError):
+            move = None
+
+        result = "invalid"
+        if game is not None and move is not None:
+            result = self.games.play(game, username, *move)
+        if result == "invalid":
+            response.send("relay_move", {"status": "FAIL", "error": "Invalid move"})
+            return
+
+        self.history.move(game, *move)
+
+        response.send("relay_move", {"status": "OK", "result": result})
+        self.__push_player(
+            game.opponent(username),
+            "relay_move",
+            {"game_id": game.id, "move": list(move), "result": result},
+        )
+
+        if result:
+            self.__end_relay_game(game, game.winner(result), "GAME_END")
+
+    @response_wrapper
+    def __relay_leave(self, request, response):
+        game = self.__relay_game(request)
+        username = self.connection_users.get(response.peername)
+
+        if game is None or username not in game.players:
+            response.send("relay_leave", {"status": "FAIL", "error": "Unknown game"})
+            return
+
+        self.__abandon_relay_game(game, username)
+        response.send("relay_leave", {"status": "OK"})
+
+    def __relay_game(self, request):
+        # None when the request has no game id or one no game has
+        game_id = getattr(request, "game_id", None)
+        return self.games.get(game_id) if type(game_id) is int else None
+
+    def __abandon_relay_game(self, game, username):
+        self.__push_player(
+            game.opponent(username), "relay_game_end", {"game_id": game.id}
+        )
+        if game.started:
+            self.__end_relay_game(game, "None", "GAME_INTERRUPTED_BY_END")
+        else:
+            self.games.remove(game)
+            self.logged_users.transition(game.players, "WAITING", "IDLE")
+
+    def __expire_relay_games(self):
+        # Scheduler job, so it takes the lock handlers get from the dispatcher
+        with self.users_lock:
+            # Matched players whose controller never started the game
+            deadline = monotonic() - self.move_timeout
+            for username, (opponent, since) in list(self.pairings.items()):
+                if since <= deadline and self.__unpair(username) is not None:
+                    self.logged_users.transition(
+                        [username, opponent], "WAITING", "IDLE"
+                    )
+
+            for game in self.games.expired(self.move_timeout):
+                if not game.started:
+                    # Nobody answered the invitation
+                    for player in game.players:
+                        self.__push_player(
+                            player, "relay_game_end", {"game_id": game.id}
+                        )
+                    self.games.remove(game)
+                    self.logged_users.transition(game.players, "WAITING", "IDLE")
+                    continue
+
+                # The player to move ran out of time and loses
+                winner = game.players[game.turn ^ 1]
+                for player in game.players:
+                    self.__push_player(
+                        player,
+                        "relay_game_end",
+                        {"game_id": game.id, "reason": "timeout", "winner": winner},
+                    )
+                self.__end_relay_game(game, winner, "GAME_INTERRUPTED_BY_TIMEOUT")
+
+    def __end_relay_game(self, game, winner, end_status):
+        # Same bookkeeping as finish_game, but the result comes from the board
+        # kept here instead of from one of the clients
+        player_one, player_two = game.players
+        self.games.remove(game)
+        self.history.game_ended(game, winner, end_status)
+
+        if winner != "None":
+            self.db.record_game_result(player_one, player_two, winner)
+            for player in game.players:
+                self.leaderboard.record(player, check_game_status(player, winner))
+
+        self.logged_users.set_state(player_one, "IDLE")
+        self.logged_users.set_state(player_two, "IDLE")
+        self.__log(
+            "end_game",
+            {
+                "end_status": end_status,
+                "winner": winner,
+                "username_player_one": player_one,
+                "username_player_two": player_two,
+            },
+        )
+
+    def __push_player(self, username, packet_name, data):
+        if (connection := self.user_connections.get(username)) is None:
+            return
+
+        try:
+            push(connection, packet_name, data)
+        except OSError:
+            pass
 
     @response_wrapper
     def __init_game(self, request, response):
         player_one, player_two = request.users
 
-        with self.logged_users_lock:
-            if request.invitation_status == "ACCEPT":
-                self.logged_users[player_one][2] = "PLAYING"
-                self.logged_users[player_two][2] = "PLAYING"
-
-                with self.db_lock:
-                    self.db.insert_log(
-                        "new_game",
-                        {
-                            "ip_player_one": self.logged_users[player_one][0],
-                            "username_player_one": player_one,
-                            "ip_player_two": self.logged_users[player_two][0],
-                            "username_player_two": player_two,
-                        },
-                    )
-            elif request.invitation_status == "REFUSED":
-                self.logged_users[player_one][2] = "IDLE"
-                self.logged_users[player_two][2] = "IDLE"
+        # Only a pair the server moved to WAITING itself can start a game
+        sender = self.connection_users.get(response.peername)
+        if (
+            sender not in request.users
+            or self.pairings.get(player_one, (None,))[0] != player_two
+        ):
+            response.send("init_game", {"status": "FAIL", "error": "Unknown game"})
+            return
+
+        self.__unpair(player_one)
+
+        if request.invitation_status == "ACCEPT":
+            self.logged_users.set_state(player_one, "PLAYING")
+            self.logged_users.set_state(player_two, "PLAYING")
+            # The direct game whose result finish_game will accept
+            self.p2p_games[player_one] = player_two
+            self.p2p_games[player_two] = player_one
+
+            self.__log(
+                "new_game",
+                {
+                    "ip_player_one": self.__ip(player_one),
+                    "username_player_one": player_one,
+                    "ip_player_two": self.__ip(player_two),
+                    "username_player_two": player_two,
+                },
+            )
+        else:
+            self.logged_users.set_state(player_one, "IDLE")
+            self.logged_users.set_state(player_two, "IDLE")
 
         response.send("init_game", {"status": "OK"})
 
@@ -245,43 +912,51 @@ class Server:
         player_one, player_two = request.users
         winner = request.winner
 
-        with self.db_lock:
-            self.db.update_user_status(
-                player_one, self.__check_game_status(player_one, winner)
-            )
-            self.db.update_user_status(
-                player_two, self.__check_game_status(player_two, winner)
+        # Only a player of a direct game started through init_game can report
+        # its result, relay games are decided by the board kept here
+        if (
+            self.connection_users.get(response.peername) not in request.users
+            or self.p2p_games.get(player_one) != player_two
+            or winner not in (player_one, player_two, "tie", "None")
+        ):
+            response.send(
+                "finish_game", {"status": "FAIL", "error": "Invalid game result"}
             )
+            return
 
-        with self.logged_users_lock:
-            with self.db_lock:
-                self.logged_users[player_one][2] = "IDLE"
-                self.logged_users[player_two][2] = "IDLE"
-                self.db.insert_log(
-                    "end_game",
-                    {
-                        "end_status": request.end_status,
-                        "winner": winner,
-                        "ip_player_one": self.logged_users[player_one][0],
-                        "username_player_one": player_one,
-                        "ip_player_two": self.logged_users[player_two][0],
-                        "username_player_two": player_two,
-                    },
-                )
+        del self.p2p_games[player_one]
+        del self.p2p_games[player_two]
 
-        response.send("finish_game", {"status": "OK"})
+        self.db.record_game_result(player_one, player_two, winner)
+        for player in (player_one, player_two):
+            self.leaderboard.record(player, check_game_status(player, winner))
 
-    def __check_game_status(self, player_name, winner):
-        player_status = None
+        self.logged_users.set_state(player_one, "IDLE")
+        self.logged_users.set_state(player_two, "IDLE")
+        self.__log(
+            "end_game",
+            {
+                "end_status": request.end_status,
+                "winner": winner,
+                "ip_player_one": self.__ip(player_one),
+                "username_player_one": player_one,
+                "ip_player_two": self.__ip(player_two),
+                "username_player_two": player_two,
+            },
+        )
 
-        if winner == "tie":
-            player_status = "tie"
-        elif winner == player_name:
-            player_status = "win"
-        else:
-            player_status = "lose"
+        response.send("finish_game", {"status": "OK"})
 
-        return player_status
+    def __ip(self, username):
+        # None once the player is gone, a game can end after that
+        player = self.logged_users.get(username)
+        return player[0] if player is not None else None
+
+    def __busy_response(self):
+        return {
+            "status": "BUSY",
+            "error": "Server is busy, try again later",
+        }
 
     def __heartbeat(self):
         address_errors = self.connection_handler.emit(
@@ -290,21 +965,39 @@ class Server:
             )
         )
 
-        if len(address_errors) > 0:
-            with self.db_lock:
-                for addr in address_errors:
-                    ip, _ = addr
-                    self.db.insert_log("connection", {"ip": ip})
+        for addr in address_errors:
+            ip, _ = addr
+            self.__log("connection", {"ip": ip})
+
+    def __reap_idle(self):
+        for ip, _ in self.connection_handler.reap_idle(self.idle_timeout):
+            self.__log("idle_disconnection", {"ip": ip})
+
+    @response_wrapper
+    def __heartbeat_reply(self, request, response):
+        # Receiving it already refreshed the connection, nothing else to do
+        response.send("heartbeat", {"status": "OK"})
+
+    def __log(self, type, data):
+        self.audit_log.write((datetime.utcnow(), type, data))
+
+    def __flush_logs(self, logs):
+        self.db.insert_logs(logs)
+
+    def __handle_signal(self, signum, frame):
+        self.scheduler.stop()
+        self.audit_log.stop()
+        self.history.stop()
+        self.auth_pool.shutdown()
+        os._exit(0)
 
     def __connection(self, request, response):
         ip, _ = response.getpeername()
-        with self.db_lock:
-            self.db.insert_log("connection", {"ip": ip})
+        self.__log("connection", {"ip": ip})
 
     def __disconnection(self, request, response):
         ip, _ = response.getpeername()
-        with self.db_lock:
-            self.db.insert_log("disconnection", {"ip": ip})
+        self.__log("disconnection", {"ip": ip})
 
 
 def main():
@@ -328,15 +1021,210 @@ def main():
         help="secure server port, default is 8081",
         default=8081,
     )
+    parser.add_argument(
+        "-np",
+        "--processes",
+        type=int,
+        help="worker processes sharing the ports with SO_REUSEPORT, more than one always uses the sql leaderboard and no user cache, default is 1",
+        default=1,
+    )
+    parser.add_argument(
+        "-ppi",
+        "--presence-poll-interval",
+        type=float,
+        help="seconds between checks for presence changes made by other worker processes, default is 0.2",
+        default=0.2,
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=["thread", "async"],
+        help="connection engine, one thread per connection or a single asyncio event loop, default is thread",
+        default="thread",
+    )
+    parser.add_argument(
+        "-aw",
+        "--auth-workers",
+        type=int,
+        help="processes used to hash and check passwords, default is the number of cores",
+    )
+    parser.add_argument(
+        "-aq",
+        "--auth-queue",
+        type=int,
+        help="password operations allowed to wait for a worker before answering BUSY, default is 64",
+        default=64,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="threads running request handlers on each port, default is chosen by python",
+    )
+    parser.add_argument(
+        "-mif",
+        "--max-in-flight",
+        type=int,
+        help="requests of a single connection handled at the same time, default is 8",
+        default=8,
+    )
+    parser.add_argument(
+        "-obl",
+        "--outbox-limit",
+        type=int,
+        help="KiB waiting to be sent to a single client before it is treated as a slow consumer, default is 1024",
+        default=1024,
+    )
+    parser.add_argument(
+        "-sc",
+        "--slow-consumer",
+        choices=["drop", "disconnect"],
+        help="what happens to broadcasts for a client whose outbox is full, default is drop",
+        default="drop",
+    )
+    parser.add_argument(
+        "-lb",
+        "--leaderboard",
+        choices=["memory", "sql"],
+        help="rank players from an in-memory index or from the database points index, default is memory",
+        default="memory",
+    )
+    parser.add_argument(
+        "-lbs",
+        "--log-batch-size",
+        type=int,
+        help="log entries or game moves written to the database in one transaction, default is 256",
+        default=256,
+    )
+    parser.add_argument(
+        "-lfi",
+        "--log-flush-interval",
+        type=float,
+        help="seconds a log entry or game move may wait before its batch is written, default is 1",
+        default=1.0,
+    )
+    parser.add_argument(
+        "-dbm",
+        "--db-mode",
+        choices=["default", "wal"],
+        help="wal enables WAL journaling, synchronous=NORMAL, mmap and a pool of reader connections, default is default",
+        default="default",
+    )
+    parser.add_argument(
+        "--db-cache-size",
+        type=int,
+        help="sqlite page cache size per connection in KiB (wal mode), default is 2000",
+        default=2000,
+    )
+    parser.add_argument(
+        "--db-mmap-size",
+        type=int,
+        help="sqlite memory-mapped I/O size in MiB (wal mode), default is 0",
+        default=0,
+    )
+    parser.add_argument(
+        "--db-readers",
+        type=int,
+        help="reader connections kept open (wal mode), default is 4",
+        default=4,
+    )
+    parser.add_argument(
+        "-mb",
+        "--match-band",
+        type=int,
+        help="points difference accepted between players paired by the matchmaking queue, default is no banding (first come, first served)",
+    )
+    parser.add_argument(
+        "-hbi",
+        "--heartbeat-interval",
+        type=float,
+        help="seconds between heartbeats and idle connection checks, default is 60",
+        default=60.0,
+    )
+    parser.add_argument(
+        "-it",
+        "--idle-timeout",
+        type=float,
+        help="seconds without hearing from a client before its connection is closed, 0 disables it, default is 180",
+        default=180.0,
+    )
+    parser.add_argument(
+        "-mt",
+        "--move-timeout",
+        type=float,
+        help="seconds a relayed game waits for a move or an invitation answer before it ends, 0 disables it, default is 120",
+        default=120.0,
+    )
+    parser.add_argument(
+        "--user-cache-size",
+        type=int,
+        help="user records kept in memory for login and password change, default is 10000",
+        default=10000,
+    )
+    parser.add_argument(
+        "--user-cache-ttl",
+        type=float,
+        help="seconds a cached user record stays valid, default is 300",
+        default=300,
+    )
 
     args = parser.parse_args()
 
+    if args.match_band is not None and args.match_band < 1:
+        parser.error("the match band must be at least 1")
+
     if args.ip_address is None:
         _socket = socket(AF_INET, SOCK_DGRAM)
         _socket.connect(("8.8.8.8", 1))
         args.ip_address = _socket.getsockname()[0]
 
-    server = Server(args)
+    if args.processes > 1:
+        run_processes(args)
+    else:
+        server = Server(args)
+        server.run()
+
+
+def run_processes(args):
+    # Workers share the ports through SO_REUSEPORT, so the kernel spreads new
+    # connections among them. What must stay consistent between them lives in
+    # the coordinator (presence) or in the database (users, ranking), the
+    # in-memory leaderboard and user cache are per process and are turned
+    # off.
+    args.leaderboard = "sql"
+    args.user_cache_size = 0
+
+    # Migrations run here once, not in every worker at the same time
+    storage = Storage(mode=args.db_mode, readers=0)
+    first_game_id = storage.get_last_game_id() + 1
+    storage.close()
+
+    coordinator = start_coordinator()
+    workers = [
+        Process(
+            target=run_worker,
+            args=(args, coordinator.address, first_game_id + index, args.processes),
+        )
+        for index in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for worker in workers:
+        worker.join()
+    coordinator.shutdown()
+
+
+def run_worker(args, coordinator_address, first_game_id, game_id_step):
+    coordinator = connect_coordinator(coordinator_address)
+    server = Server(args, coordinator.presence(), first_game_id, game_id_step)
     server.run()
 
 
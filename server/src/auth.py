@@ -1,6 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import BoundedSemaphore
 import bcrypt
 
 
+class AuthBusyError(Exception):
+    pass
+
+
 def hash_password(raw_password):
     salt = bcrypt.gensalt()
     hashed_password = bcrypt.hashpw(raw_password, salt)
@@ -9,3 +16,30 @@ def hash_password(raw_password):
 
 def check_password(raw_password, hashed_password):
     return bcrypt.hashpw(raw_password, hashed_password) == hashed_password
+
+
+class AuthWorkerPool:
+    def __init__(self, workers=None, max_pending=64):
+        # forkserver avoids forking the threaded server process itself
+        self.__executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("forkserver")
+        )
+        self.__pending = BoundedSemaphore(max_pending)
+
+    def hash_password(self, raw_password):
+        return self.__run(hash_password, raw_password)
+
+    def check_password(self, raw_password, hashed_password):
+        return self.__run(check_password, raw_password, hashed_password)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __run(self, func, *args):
+        if not self.__pending.acquire(blocking=False):
+            raise AuthBusyError("Too many pending authentication requests")
+
+        try:
+            return self.__executor.submit(func, *args).result()
+        finally:
+            self.__pending.release()
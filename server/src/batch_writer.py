@@ -0,0 +1,69 @@
+from queue import Queue, Empty
+from threading import Thread
+from time import monotonic
+
+
+class BatchWriter(Thread):
+    # Collects items written from any thread and hands them to flush in
+    # batches, once batch_size items are waiting or flush_interval seconds
+    # after the first one arrived, whichever comes first.
+
+    __STOP = object()
+
+    def __init__(self, flush, batch_size=256, flush_interval=1.0, max_pending=10000):
+        self.flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.__queue = Queue(max_pending)
+
+        Thread.__init__(self, daemon=True)
+
+    def write(self, item):
+        self.__queue.put(item)
+
+    def stop(self):
+        self.__queue.put(self.__STOP)
+        self.join()
+
+    def run(self):
+        batch = []
+        deadline = None
+
+        while True:
+            timeout = None if not batch else max(deadline - monotonic(), 0)
+
+            try:
+                item = self.__queue.get(timeout=timeout)
+            except Empty:
+                item = None
+
+            if item is self.__STOP:
+                break
+
+            if item is not None:
+                if not batch:
+                    deadline = monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (len(batch) >= self.batch_size or monotonic() >= deadline):
+                self.__flush(batch)
+                batch = []
+
+        # Drain whatever is still queued when the server is shutting down
+        while True:
+            try:
+                item = self.__queue.get_nowait()
+            except Empty:
+                break
+            if item is not self.__STOP:
+                batch.append(item)
+
+        if batch:
+            self.__flush(batch)
+
+    def __flush(self, batch):
+        try:
+            self.flush(batch)
+        except Exception as error:
+            print("Failed to write batch:", error)
@@ -4,18 +4,262 @@ from socket import (
     SOCK_STREAM,
     SOL_SOCKET,
     SO_REUSEADDR,
+    SO_REUSEPORT,
+    socketpair,
+    SHUT_RDWR,
+    MSG_DONTWAIT,
     create_connection,
     error as socket_error,
 )
-from ssl import SSLContext, PROTOCOL_TLS_CLIENT, PROTOCOL_TLS_SERVER
-from threading import Thread, Lock, Timer
+from ssl import (
+    SSLContext,
+    SSLSocket,
+    SSLError,
+    PROTOCOL_TLS_CLIENT,
+    PROTOCOL_TLS_SERVER,
+    OP_NO_TICKET,
+)
+from threading import Thread, Lock, BoundedSemaphore, get_ident, current_thread
 from types import SimpleNamespace
+from collections import deque
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from contextlib import ExitStack
+from traceback import print_exception
+from concurrent.futures import ThreadPoolExecutor
+from asyncio import new_event_loop, set_event_loop, run_coroutine_threadsafe
+from time import monotonic
+from src.protocol import PacketDecoder, ProtocolError, encode_packet
+import asyncio
 import json
 
 
+def create_server_tls_context(tls_cert, tls_key, session_tickets=2):
+    # One context per listening port: OpenSSL keeps its server session cache
+    # and ticket keys in the context, so clients can resume their sessions
+    # instead of doing a full handshake on every login.
+    context = SSLContext(PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(tls_cert, tls_key)
+    context.options &= ~OP_NO_TICKET
+    context.num_tickets = session_tickets
+    return context
+
+
+class EventDispatcher:
+    def __init__(self, max_workers=None):
+        self.__events = {}
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def on(self, event, event_handler, locks=()):
+        # Locks are always taken in the same order, so two handlers sharing
+        # some state can never deadlock each other
+        self.__events[event] = (event_handler, sorted(locks, key=id))
+
+    def call(self, event, data, connection):
+        if (entry := self.__events.get(event)) is None:
+            return
+
+        event_handler, locks = entry
+        with ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            event_handler(data, connection)
+
+    def submit(self, event, data, connection):
+        future = self.__executor.submit(self.call, event, data, connection)
+        future.add_done_callback(self.__report_error)
+        return future
+
+    def __report_error(self, future):
+        if (error := future.exception()) is not None:
+            print_exception(error)
+
+
+class Outbox(Thread):
+    # Connections whose peer does not read as fast as we write keep the rest
+    # of their packets in an outbox. This single thread waits for all of them
+    # to become writable again and drains them, so no handler ever blocks on
+    # a slow client.
+
+    def __init__(self):
+        self.__selector = DefaultSelector()
+        self.__wakeup, self.__notify = socketpair()
+        self.__wakeup.setblocking(False)
+        self.__notify.setblocking(False)
+        self.__selector.register(self.__wakeup, EVENT_READ)
+
+        # Registrations come from other threads and are applied in order by
+        # the outbox thread, the selector itself is only touched here
+        self.__changes_lock = Lock()
+        self.__changes = []
+
+        Thread.__init__(self, daemon=True)
+
+    def watch(self, connection):
+        self.__change(connection, True)
+
+    def forget(self, connection):
+        self.__change(connection, False)
+
+    def run(self):
+        while True:
+            for key, _ in self.__selector.select():
+                if key.fileobj is self.__wakeup:
+                    self.__apply_changes()
+                else:
+                    self.__flush(key.fileobj)
+
+    def __change(self, connection, watch):
+        with self.__changes_lock:
+            self.__changes.append((connection, watch))
+
+        try:
+            self.__notify.send(b"\0")
+        except BlockingIOError:
+            # The outbox thread has not woken up for the previous ones yet
+            pass
+
+    def __apply_changes(self):
+        try:
+            self.__wakeup.recv(4096)
+        except BlockingIOError:
+            pass
+
+        with self.__changes_lock:
+            changes, self.__changes = self.__changes, []
+
+        for connection, watch in changes:
+            try:
+                if watch:
+                    self.__selector.register(connection, EVENT_WRITE)
+                else:
+                    self.__selector.unregister(connection)
+            except (KeyError, ValueError, OSError):
+                pass
+
+    def __flush(self, connection):
+        try:
+            is_empty = connection.flush()
+        except OSError:
+            connection.abort()
+            is_empty = True
+
+        if is_empty:
+            self.__selector.unregister(connection)
+
+
+class SocketConnection:
+    # Responses for requests of the same connection are sent from different
+    # worker threads, so writes are serialised to keep packets whole.
+    #
+    # Plain sockets are never written in blocking mode: whatever the kernel
+    # does not take right away waits in a bounded outbox drained by the
+    # Outbox thread. Once it is full, broadcast packets are dropped or the
+    # connection is closed, depending on the slow consumer policy. TLS
+    # sockets take no send flags and are written as usual.
+
+    def __init__(
+        self, connection, outbox=None, outbox_limit=1024 * 1024, slow_consumer="drop"
+    ):
+        self.__connection = connection
+        self.__send_lock = Lock()
+        self.__peername = connection.getpeername()
+        self.last_seen = monotonic()
+
+        self.__outbox = None if isinstance(connection, SSLSocket) else outbox
+        self.__outbox_limit = outbox_limit
+        self.__slow_consumer = slow_consumer
+        self.__pending = deque()
+        self.__pending_bytes = 0
+
+    def sendall(self, payload):
+        return self.__send(payload, False)
+
+    def send_nowait(self, payload):
+        # Same as sendall for packets that may be lost, like broadcasts
+        return self.__send(payload, True)
+
+    def flush(self):
+        with self.__send_lock:
+            while self.__pending:
+                chunk = self.__pending[0]
+                try:
+                    sent = self.__connection.send(chunk, MSG_DONTWAIT)
+                except BlockingIOError:
+                    return False
+
+                self.__pending_bytes -= sent
+                if sent < len(chunk):
+                    self.__pending[0] = memoryview(chunk)[sent:]
+                    return False
+                self.__pending.popleft()
+
+            return True
+
+    def fileno(self):
+        return self.__connection.fileno()
+
+    def __send(self, payload, droppable):
+        with self.__send_lock:
+            if self.__outbox is None:
+                self.__connection.sendall(payload)
+                return True
+
+            if self.__pending_bytes + len(payload) > self.__outbox_limit:
+                if not droppable or self.__slow_consumer == "disconnect":
+                    self.abort()
+                return False
+
+            if not self.__pending:
+                try:
+                    sent = self.__connection.send(payload, MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+
+                if sent == len(payload):
+                    return True
+
+                payload = memoryview(payload)[sent:]
+                self.__outbox.watch(self)
+
+            self.__pending.append(payload)
+            self.__pending_bytes += len(payload)
+            return True
+
+    def recv_into(self, buffer):
+        nbytes = self.__connection.recv_into(buffer)
+        self.last_seen = monotonic()
+        return nbytes
+
+    def getpeername(self):
+        return self.__peername
+
+    def abort(self):
+        # Wakes up the thread blocked reading this connection, which then
+        # goes through the usual disconnection path
+        try:
+            self.__connection.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.__connection.close()
+
+
 class ServerEventHandler(Thread):
     def __init__(
-        self, ip_address, port, bufflen=1024, tls=False, tls_cert=None, tls_key=None
+        self,
+        ip_address,
+        port,
+        bufflen=1024,
+        tls=False,
+        tls_cert=None,
+        tls_key=None,
+        tls_session_tickets=2,
+        max_workers=None,
+        max_in_flight=8,
+        outbox_limit=1024 * 1024,
+        slow_consumer="drop",
+        reuse_port=False,
     ):
         self.ip_address = ip_address
         self.port = port
@@ -23,9 +267,18 @@ class ServerEventHandler(Thread):
         self.tls = tls
         self.tls_cert = tls_cert
         self.tls_key = tls_key
+        self.tls_context = (
+            create_server_tls_context(tls_cert, tls_key, tls_session_tickets)
+            if tls
+            else None
+        )
+        self.max_in_flight = max_in_flight
+        self.reuse_port = reuse_port
+        self.outbox_limit = outbox_limit
+        self.slow_consumer = slow_consumer
 
-        self.__events_lock = Lock()
-        self.__events = {}
+        self.__dispatcher = EventDispatcher(max_workers)
+        self.__outbox = None if tls else Outbox()
         self.__connections_lock = Lock()
         self.__connections = {}
         self.__is_running = True
@@ -33,88 +286,363 @@ class ServerEventHandler(Thread):
 
         Thread.__init__(self)
 
-    def on(self, event, event_handler):
-        self.__events[event] = event_handler
+    def on(self, event, event_handler, locks=()):
+        self.__dispatcher.on(event, event_handler, locks)
 
     def emit(self, payload):
         connection_errors = []
         if self.__is_running:
-            with self.__connections_lock:
-                for address, connection_info in self.__connections.items():
-                    connection, _ = connection_info
-                    try:
-                        connection.sendall(payload)
-                    except ConnectionResetError:
-                        connection_errors.append(address)
+            packet = encode_packet(payload)
+            for address, connection in self.__open_connections():
+                try:
+                    connection.send_nowait(packet)
+                except OSError:
+                    connection_errors.append(address)
         return connection_errors
 
+    def reap_idle(self, timeout):
+        # Connections that sent nothing for longer than the timeout are
+        # aborted, their threads then dispatch the disconnection event
+        deadline = monotonic() - timeout
+        reaped = []
+        for address, connection in self.__open_connections():
+            if connection.last_seen < deadline:
+                connection.abort()
+                reaped.append(address)
+        return reaped
+
+    def __open_connections(self):
+        with self.__connections_lock:
+            return [
+                (address, connection)
+                for address, (connection, _) in self.__connections.items()
+                if connection is not None
+            ]
+
     def run(self):
+        if self.__outbox is not None:
+            self.__outbox.start()
+
         self.__connection = socket(AF_INET, SOCK_STREAM)
         self.__connection.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.__connection.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.__connection.bind((self.ip_address, self.port))
         self.__connection.listen(1)
 
-        if self.tls:
-            context = SSLContext(PROTOCOL_TLS_SERVER)
-            context.load_cert_chain(self.tls_cert, self.tls_key)
-            self.__connection = context.wrap_socket(self.__connection, server_side=True)
-
         while self.__is_running:
             connection, address = self.__connection.accept()
             connection_th = Thread(
                 target=self.__handle_connection, args=(connection, address), daemon=True
             )
-            connection_th.start()
             with self.__connections_lock:
-                self.__connections[address] = (connection, connection_th)
+                self.__connections[address] = (None, connection_th)
+            connection_th.start()
 
-            self.__events.get("connection", lambda *_: _)({}, connection)
+    def session_stats(self):
+        return self.tls_context.session_stats() if self.tls else {}
 
     def __handle_connection(self, connection, address):
-        connection.sendall(b"OK")
-        while self.__is_running:
-            payload = connection.recv(self.bufflen)
+        if self.tls:
+            # The handshake runs on the connection thread so a slow client
+            # does not hold up the accept loop
+            try:
+                connection = self.tls_context.wrap_socket(connection, server_side=True)
+            except (socket_error, SSLError):
+                connection.close()
+                with self.__connections_lock:
+                    self.__connections.pop(address, None)
+                return
+
+        connection = SocketConnection(
+            connection, self.__outbox, self.outbox_limit, self.slow_consumer
+        )
+        with self.__connections_lock:
+            self.__connections[address] = (connection, current_thread())
 
-            if payload:
-                data = json.loads(payload)
-                event_type = data.get("packet_name")
+        self.__dispatcher.call("connection", {}, connection)
+
+        decoder = PacketDecoder(self.bufflen)
+        in_flight = BoundedSemaphore(self.max_in_flight)
+        connection.sendall(encode_packet(b"OK"))
+        while self.__is_running:
+            try:
+                packets = decoder.receive(connection)
+                if packets is not None:
+                    requests = [
+                        (data.get("packet_name"), data)
+                        for data in map(json.loads, packets)
+                    ]
+            except (socket_error, ProtocolError, ValueError, AttributeError):
+                # A payload that is not a JSON object is a protocol error too
+                packets = None
 
-                with self.__events_lock:
-                    self.__events.get(event_type, lambda *_: _)(data, connection)
+            if packets is not None:
+                for event_type, data in requests:
+                    # Stop reading from a connection that already has enough
+                    # requests being handled
+                    in_flight.acquire()
+                    self.__dispatcher.submit(
+                        event_type, data, connection
+                    ).add_done_callback(lambda _: in_flight.release())
             else:
+                # The disconnection has to run after the requests the
+                # connection already sent, so it waits for all of them
+                for _ in range(self.max_in_flight):
+                    in_flight.acquire()
+
                 with self.__connections_lock:
-                    if address in self.__connections:
-                        self.__connections.pop(address)
-                        self.__events.get("disconnection", lambda *_: _)({}, connection)
+                    is_connected = self.__connections.pop(address, None) is not None
+
+                if is_connected:
+                    self.__dispatcher.call("disconnection", {}, connection)
+                if self.__outbox is not None:
+                    self.__outbox.forget(connection)
+                connection.close()
                 break
 
 
-def set_interval(func, sec):
-    def func_wrapper():
-        set_interval(func, sec)
-        func()
+class StreamConnection:
+    # Handlers run outside of the event loop, so writes coming from them are
+    # handed back to the loop thread instead of touching the transport. The
+    # transport buffers what the socket does not take right away, and that
+    # buffer is bounded the same way as the outbox of SocketConnection.
+
+    def __init__(self, writer, loop, outbox_limit=1024 * 1024, slow_consumer="drop"):
+        self.__writer = writer
+        self.__loop = loop
+        self.__loop_thread = get_ident()
+        self.__peername = writer.get_extra_info("peername")
+        self.__outbox_limit = outbox_limit
+        self.__slow_consumer = slow_consumer
+        self.last_seen = monotonic()
+
+    def sendall(self, payload):
+        return self.__send(payload, False)
+
+    def send_nowait(self, payload):
+        return self.__send(payload, True)
+
+    def __send(self, payload, droppable):
+        pending = self.__writer.transport.get_write_buffer_size()
+        if pending + len(payload) > self.__outbox_limit:
+            if not droppable or self.__slow_consumer == "disconnect":
+                self.abort()
+            return False
+
+        if get_ident() == self.__loop_thread:
+            self.__writer.write(payload)
+        else:
+            self.__loop.call_soon_threadsafe(self.__writer.write, payload)
+        return True
+
+    def getpeername(self):
+        return self.__peername
+
+    def is_closing(self):
+        return self.__writer.is_closing()
+
+    def abort(self):
+        self.__loop.call_soon_threadsafe(self.__writer.transport.abort)
+
+    def close(self):
+        if get_ident() == self.__loop_thread:
+            self.__writer.close()
+        else:
+            self.__loop.call_soon_threadsafe(self.__writer.close)
+
+
+class AsyncServerEventHandler(Thread):
+    def __init__(
+        self,
+        ip_address,
+        port,
+        bufflen=1024,
+        tls=False,
+        tls_cert=None,
+        tls_key=None,
+        tls_session_tickets=2,
+        backlog=1024,
+        max_workers=None,
+        max_in_flight=8,
+        outbox_limit=1024 * 1024,
+        slow_consumer="drop",
+        reuse_port=False,
+    ):
+        self.ip_address = ip_address
+        self.port = port
+        self.bufflen = bufflen
+        self.tls = tls
+        self.tls_cert = tls_cert
+        self.tls_key = tls_key
+        self.tls_context = (
+            create_server_tls_context(tls_cert, tls_key, tls_session_tickets)
+            if tls
+            else None
+        )
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.max_in_flight = max_in_flight
+        self.outbox_limit = outbox_limit
+        self.slow_consumer = slow_consumer
+
+        self.__dispatcher = EventDispatcher(max_workers)
+        self.__connections = {}
+        self.__is_running = True
+        self.__loop = None
+
+        Thread.__init__(self)
+
+    def on(self, event, event_handler, locks=()):
+        self.__dispatcher.on(event, event_handler, locks)
+
+    def emit(self, payload):
+        if not self.__is_running or self.__loop is None:
+            return []
+
+        return run_coroutine_threadsafe(
+            self.__broadcast(encode_packet(payload)), self.__loop
+        ).result()
+
+    def reap_idle(self, timeout):
+        if not self.__is_running or self.__loop is None:
+            return []
+
+        return run_coroutine_threadsafe(
+            self.__reap(monotonic() - timeout), self.__loop
+        ).result()
+
+    def session_stats(self):
+        return self.tls_context.session_stats() if self.tls else {}
+
+    def run(self):
+        self.__loop = new_event_loop()
+        set_event_loop(self.__loop)
+        self.__loop.run_until_complete(self.__serve())
+
+    async def __serve(self):
+        server = await asyncio.start_server(
+            self.__handle_connection,
+            self.ip_address,
+            self.port,
+            ssl=self.tls_context,
+            reuse_address=True,
+            reuse_port=self.reuse_port,
+            backlog=self.backlog,
+        )
+
+        async with server:
+            await server.serve_forever()
+
+    async def __broadcast(self, payload):
+        connection_errors = []
+        for address, connection in list(self.__connections.items()):
+            if connection.is_closing():
+                connection_errors.append(address)
+            else:
+                connection.send_nowait(payload)
+        return connection_errors
+
+    async def __reap(self, deadline):
+        reaped = []
+        for address, connection in list(self.__connections.items()):
+            if connection.last_seen < deadline:
+                connection.abort()
+                reaped.append(address)
+        return reaped
+
+    async def __handle_connection(self, reader, writer):
+        connection = StreamConnection(
+            writer, self.__loop, self.outbox_limit, self.slow_consumer
+        )
+        address = connection.getpeername()
+
+        decoder = PacketDecoder(self.bufflen)
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        self.__connections[address] = connection
+        self.__dispatch("connection", {}, connection)
+        connection.sendall(encode_packet(b"OK"))
+
+        try:
+            while self.__is_running:
+                chunk = await reader.read(self.bufflen)
+
+                if not chunk:
+                    break
+
+                connection.last_seen = monotonic()
+
+                for payload in decoder.feed(chunk):
+                    data = json.loads(payload)
+
+                    await in_flight.acquire()
+                    self.__dispatch(
+                        data.get("packet_name"), data, connection
+                    ).add_done_callback(lambda _: in_flight.release())
+        except (ConnectionError, OSError, ProtocolError, ValueError, AttributeError):
+            # A payload that is not a JSON object is a protocol error too
+            pass
+        finally:
+            # The disconnection has to run after the requests the connection
+            # already sent, so it waits for all of them
+            for _ in range(self.max_in_flight):
+                await in_flight.acquire()
+
+            if self.__connections.pop(address, None):
+                self.__dispatch("disconnection", {}, connection)
+            writer.close()
+
+    def __dispatch(self, event_type, data, connection):
+        return asyncio.wrap_future(
+            self.__dispatcher.submit(event_type, data, connection), loop=self.__loop
+        )
+
+
+def encode_request(packet_name, data={}):
+    return encode_packet(
+        json.dumps(
+            {"packet_type": "request", "packet_name": packet_name, **data}
+        ).encode("ascii")
+    )
+
+
+def push(connection, packet_name, data={}):
+    return connection.sendall(encode_request(packet_name, data))
 
-    t = Timer(sec, func_wrapper)
-    t.start()
 
-    return t
+def broadcast(connections, packet_name, data={}):
+    # The packet is serialised once and the same buffer is queued on every
+    # connection, slow consumers may drop it
+    packet = encode_request(packet_name, data)
+    connection_errors = []
+    for connection in connections:
+        try:
+            connection.send_nowait(packet)
+        except OSError:
+            connection_errors.append(connection)
+    return connection_errors
 
 
 def response_wrapper(handler):
     def _send(request, connection):
         def send(packet_name, data={}, packet_type="response"):
             connection.sendall(
-                json.dumps(
-                    {
-                        "packet_type": packet_type,
-                        "packet_name": packet_name,
-                        "request_id": request.request_id,
-                        **data,
-                    }
-                ).encode("ascii")
+                encode_packet(
+                    json.dumps(
+                        {
+                            "packet_type": packet_type,
+                            "packet_name": packet_name,
+                            "request_id": request.request_id,
+                            **data,
+                        }
+                    ).encode("ascii")
+                )
             )
 
-        return SimpleNamespace(send=send, peername=connection.getpeername())
+        return SimpleNamespace(
+            send=send, peername=connection.getpeername(), connection=connection
+        )
 
     def wrapper(self, request, connection):
         req_obg = SimpleNamespace(**request)
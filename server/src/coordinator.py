@@ -0,0 +1,38 @@
+from multiprocessing.managers import BaseManager
+from src.presence import PresenceStore
+
+import signal
+
+
+class Coordinator(BaseManager):
+    # Runs in its own process and owns the presence store shared by all the
+    # server workers. Workers call it through proxies, so each method of the
+    # store is atomic across processes.
+    pass
+
+
+_presence_store = None
+
+
+def _presence():
+    global _presence_store
+    if _presence_store is None:
+        _presence_store = PresenceStore()
+    return _presence_store
+
+
+Coordinator.register("presence", callable=_presence)
+
+
+def start_coordinator():
+    coordinator = Coordinator()
+    # Interrupts go to the whole process group, the parent decides when the
+    # coordinator stops
+    coordinator.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    return coordinator
+
+
+def connect_coordinator(address):
+    coordinator = Coordinator(address=address)
+    coordinator.connect()
+    return coordinator
@@ -1,45 +1,167 @@
-from os import curdir
+from os import curdir, listdir, path
 from typing import Counter
 from datetime import datetime
+from contextlib import contextmanager
+from queue import Queue
+from threading import Lock
 from src.domain.user import User
+from src.domain.game import check_game_status
 import sqlite3
 import json
 
+# Statements are fixed strings with placeholders, so sqlite3 compiles each one
+# once per connection and reuses it from its statement cache.
+INSERT_USER = (
+    "INSERT INTO users (username, password, win_count, lose_count, tie_count) "
+    "VALUES (?, ?, 0, 0, 0)"
+)
+SELECT_USER = "SELECT username, password FROM users WHERE username = ?"
+SELECT_ALL_USERS = "SELECT username, win_count, lose_count, tie_count FROM users"
+SELECT_TOP_USERS = (
+    "SELECT username, win_count, lose_count, tie_count, points FROM users "
+    "ORDER BY points DESC, username LIMIT ? OFFSET ?"
+)
+SELECT_USER_POINTS = "SELECT points FROM users WHERE username = ?"
+SELECT_USER_RANK = (
+    "SELECT (SELECT COUNT(*) FROM users WHERE points > ?) + "
+    "(SELECT COUNT(*) FROM users WHERE points = ? AND username < ?)"
+)
+COUNT_USERS = "SELECT COUNT(*) FROM users"
+UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ?"
+UPDATE_USER_STATUS = (
+    "UPDATE users SET win_count = win_count + ?, lose_count = lose_count + ?, "
+    "tie_count = tie_count + ? WHERE username = ?"
+)
+INSERT_LOG = "INSERT INTO logs (created_at, type, log) VALUES (?, ?, ?)"
+SELECT_LAST_GAME_ID = "SELECT MAX(id) FROM games"
+INSERT_GAME = (
+    "INSERT INTO games (id, player_one, player_two, size, k, started_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+INSERT_MOVE = (
+    "INSERT INTO moves (game_id, number, row, col, played_at) VALUES (?, ?, ?, ?, ?)"
+)
+UPDATE_GAME_END = (
+    "UPDATE games SET ended_at = ?, end_status = ?, winner = ? WHERE id = ?"
+)
+GAME_COLUMNS = (
+    "id, player_one, player_two, size, k, started_at, ended_at, end_status, winner"
+)
+SELECT_GAME = f"SELECT {GAME_COLUMNS} FROM games WHERE id = ?"
+# One index range per side of the game, merged by start time
+SELECT_PLAYER_GAMES = (
+    f"SELECT {GAME_COLUMNS} FROM games WHERE player_one = ? "
+    f"UNION ALL SELECT {GAME_COLUMNS} FROM games WHERE player_two = ? "
+    "ORDER BY started_at DESC LIMIT ?"
+)
+SELECT_GAME_MOVES = (
+    "SELECT row, col, played_at FROM moves WHERE game_id = ? ORDER BY number"
+)
+
 
 class ConstraintError(Exception):
     pass
 
 
 class Storage:
-    def __init__(self):
+    def __init__(
+        self,
+        database="./src/tictactoe.db",
+        mode="default",
+        cache_size=2000,
+        mmap_size=0,
+        readers=4,
+    ):
+        self._database = database
         self._migration = "./src/migration.sql"
-        self._connection = sqlite3.connect(
-            "./src/tictactoe.db", check_same_thread=False
-        )
+        self._migrations_dir = "./src/migrations"
+        self._mode = mode
+        self._cache_size = cache_size
+        self._mmap_size = mmap_size
+
+        # Every write goes through a single connection. In wal mode, reads use
+        # a small pool of their own connections so they do not wait for writes.
+        self._write_lock = Lock()
+        self._cursors = {}
+        self._connection = self._connect()
         self.run_migrations()
 
+        # Without reader connections, reads share the writer one
+        self._readers = None
+        if self._mode == "wal" and readers > 0:
+            self._readers = Queue()
+            for _ in range(readers):
+                self._readers.put(self._connect())
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self._database, check_same_thread=False, cached_statements=64
+        )
+
+        if self._mode == "wal":
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(f"PRAGMA cache_size = -{int(self._cache_size)}")
+            connection.execute(f"PRAGMA mmap_size = {int(self._mmap_size)}")
+
+        # A connection is only used by one thread at a time, so it keeps a
+        # single cursor around instead of opening one per query
+        self._cursors[connection] = connection.cursor()
+        return connection
+
+    @contextmanager
+    def _reader(self):
+        if self._readers is None:
+            with self._write_lock:
+                yield self._cursors[self._connection]
+            return
+
+        connection = self._readers.get()
+        try:
+            yield self._cursors[connection]
+        finally:
+            self._readers.put(connection)
+
+    @contextmanager
+    def _writer(self):
+        with self._write_lock:
+            yield self._cursors[self._connection]
+
+    def close(self):
+        with self._write_lock:
+            for connection in list(self._cursors):
+                self._cursors.pop(connection).close()
+                connection.close()
+
     def run_migrations(self):
         with open(self._migration, "r") as migrations:
             cursor = self._connection.cursor()
             cursor.executescript(migrations.read())
             cursor.close()
 
-    def insert_user(self, user):
+        # Numbered migrations run once, user_version keeps the last one applied
         cursor = self._connection.cursor()
-        cursor.execute(
-            "INSERT INTO users (username, password, win_count, lose_count, tie_count) VALUES (?, ?, ?, ?, ?)",
-            (user.username, user.password, 0, 0, 0),
-        )
-        self._connection.commit()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+
+        for filename in sorted(listdir(self._migrations_dir)):
+            number = int(filename.split("_", 1)[0])
+            if number <= version:
+                continue
+
+            with open(path.join(self._migrations_dir, filename), "r") as migration:
+                cursor.executescript(migration.read())
+            cursor.execute(f"PRAGMA user_version = {number}")
+
         cursor.close()
 
+    def insert_user(self, user):
+        with self._writer() as cursor:
+            cursor.execute(INSERT_USER, (user.username, user.password))
+            cursor.connection.commit()
+
     def get_user(self, username):
-        cursor = self._connection.cursor()
-        cursor.execute(
-            "SELECT username, password FROM users WHERE username = '%s'" % username
-        )
-        user = cursor.fetchone()
-        cursor.close()
+        with self._reader() as cursor:
+            user = cursor.execute(SELECT_USER, (username,)).fetchone()
 
         if not user:
             return None
@@ -48,36 +170,112 @@ class Storage:
         return User(username, password)
 
     def get_all_users(self):
-        cursor = self._connection.cursor()
-        cursor.execute("SELECT username, win_count, lose_count, tie_count FROM users")
-        users = cursor.fetchall()
-        cursor.close()
+        with self._reader() as cursor:
+            users = cursor.execute(SELECT_ALL_USERS).fetchall()
 
         if not users:
             return None
 
         return users
 
-    def change_password(self, username, password):
-        cursor = self._connection.cursor()
-        cursor.execute(
-            "UPDATE users SET password = ? WHERE username = ?", (password, username)
-        )
+    def get_top_users(self, limit=None, offset=0):
+        with self._reader() as cursor:
+            return cursor.execute(
+                SELECT_TOP_USERS, (-1 if limit is None else limit, offset)
+            ).fetchall()
+
+    def get_user_points(self, username):
+        with self._reader() as cursor:
+            user = cursor.execute(SELECT_USER_POINTS, (username,)).fetchone()
+            return user[0] if user else None
 
-        self._connection.commit()
+    def get_user_rank(self, username):
+        with self._reader() as cursor:
+            user = cursor.execute(SELECT_USER_POINTS, (username,)).fetchone()
+
+            if not user:
+                return None
+
+            return cursor.execute(
+                SELECT_USER_RANK, (user[0], user[0], username)
+            ).fetchone()[0]
+
+    def count_users(self):
+        with self._reader() as cursor:
+            return cursor.execute(COUNT_USERS).fetchone()[0]
+
+    def change_password(self, username, password):
+        with self._writer() as cursor:
+            cursor.execute(UPDATE_PASSWORD, (password, username))
+            cursor.connection.commit()
 
     def update_user_status(self, username, game_status):
-        cursor = self._connection.cursor()
-        sql_query = f"UPDATE users SET {game_status}_count = {game_status}_count + 1 WHERE username = '{username}'"
-        cursor.execute(sql_query)
+        with self._writer() as cursor:
+            cursor.execute(UPDATE_USER_STATUS, self.__status_row(username, game_status))
+            cursor.connection.commit()
 
-        self._connection.commit()
+    def record_game_result(self, player_one, player_two, winner):
+        with self._writer() as cursor:
+            cursor.executemany(
+                UPDATE_USER_STATUS,
+                (
+                    self.__status_row(player, check_game_status(player, winner))
+                    for player in (player_one, player_two)
+                ),
+            )
+            cursor.connection.commit()
 
     def insert_log(self, type, data):
-        cursor = self._connection.cursor()
-        sql_query = f"INSERT INTO logs (created_at, type, log) VALUES (?, ?, ?)"
-        cursor.execute(sql_query, (datetime.utcnow(), type, json.dumps(data)))
-        self._connection.commit()
+        with self._writer() as cursor:
+            cursor.execute(INSERT_LOG, (datetime.utcnow(), type, json.dumps(data)))
+            cursor.connection.commit()
+
+    def insert_logs(self, logs):
+        with self._writer() as cursor:
+            cursor.executemany(
+                INSERT_LOG,
+                (
+                    (created_at, type, json.dumps(data))
+                    for created_at, type, data in logs
+                ),
+            )
+            cursor.connection.commit()
+
+    def get_last_game_id(self):
+        with self._reader() as cursor:
+            return cursor.execute(SELECT_LAST_GAME_ID).fetchone()[0] or 0
+
+    def insert_game_history(self, games, moves, ends):
+        # One transaction for the whole batch. A game is always in the same
+        # batch as its first moves or an earlier one, so inserting games
+        # first keeps every move and end after the row it belongs to.
+        with self._writer() as cursor:
+            cursor.executemany(INSERT_GAME, games)
+            cursor.executemany(INSERT_MOVE, moves)
+            cursor.executemany(UPDATE_GAME_END, ends)
+            cursor.connection.commit()
+
+    def get_game(self, game_id):
+        with self._reader() as cursor:
+            return cursor.execute(SELECT_GAME, (game_id,)).fetchone()
+
+    def get_player_games(self, username, limit):
+        with self._reader() as cursor:
+            return cursor.execute(
+                SELECT_PLAYER_GAMES, (username, username, limit)
+            ).fetchall()
+
+    def get_game_moves(self, game_id):
+        with self._reader() as cursor:
+            return cursor.execute(SELECT_GAME_MOVES, (game_id,)).fetchall()
+
+    def __status_row(self, username, game_status):
+        return (
+            game_status == "win",
+            game_status == "lose",
+            game_status == "tie",
+            username,
+        )
 
 
 if __name__ == "__main__":
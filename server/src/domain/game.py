@@ -0,0 +1,11 @@
+def check_game_status(player_name, winner):
+    player_status = None
+
+    if winner == "tie":
+        player_status = "tie"
+    elif winner == player_name:
+        player_status = "win"
+    else:
+        player_status = "lose"
+
+    return player_status
@@ -0,0 +1,123 @@
+from functools import lru_cache
+
+# Boards larger than this do not fit a terminal
+MAX_SIZE = 19
+
+
+def valid_board(size, k):
+    return type(size) is int and type(k) is int and 3 <= k <= size <= MAX_SIZE
+
+
+@lru_cache(maxsize=None)
+def square_lines(size, k):
+    # Square (row, col) of the board is bit row * size + col of a player's
+    # mask. For every square, the masks of the k-long runs going through it
+    # in each of the four directions: a move can only complete one of these,
+    # so checking it costs at most 4k mask comparisons whatever the size.
+    lines = [[] for _ in range(size * size)]
+
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_row = row + d_row * (k - 1)
+                end_col = col + d_col * (k - 1)
+                if not (0 <= end_row < size and 0 <= end_col < size):
+                    continue
+
+                squares = [(row + d_row * i) * size + col + d_col * i for i in range(k)]
+                mask = sum(1 << square for square in squares)
+                for square in squares:
+                    lines[square].append(mask)
+
+    return tuple(tuple(square) for square in lines)
+
+
+class TicTacToe:
+    # A size x size board where k marks in a row win, 3x3 and 3 by default.
+    # The board is one bit mask per player, so placing a move and checking
+    # for a winner are a few integer operations.
+    __slots__ = (
+        "player",
+        "oponent",
+        "size",
+        "k",
+        "winner",
+        "moves_count",
+        "player_mask",
+        "oponent_mask",
+        "__lines",
+    )
+
+    def __init__(self, player, oponent, size=3, k=None) -> None:
+        self.size = size
+        self.k = k or size
+        self.__lines = square_lines(self.size, self.k)
+        self.restart(player, oponent)
+
+    def restart(self, player, oponent):
+        self.player = player
+        self.oponent = oponent
+        self.winner = None
+        self.moves_count = 0
+        self.player_mask = 0
+        self.oponent_mask = 0
+
+    def play(self, row, col):
+        return self.__insert_move(row, col, True)
+
+    def update_oponent_move(self, row, col):
+        return self.__insert_move(row, col, False)
+
+    def get_winner(self):
+        return self.winner
+
+    def main_player(self):
+        return self.player
+
+    def __insert_move(self, row, col, is_player):
+        if row not in range(1, self.size + 1) or col not in range(1, self.size + 1):
+            return "invalid"
+
+        square = (row - 1) * self.size + col - 1
+        bit = 1 << square
+
+        if self.winner or (self.player_mask | self.oponent_mask) & bit:
+            return "invalid"
+
+        self.moves_count += 1
+        if is_player:
+            self.player_mask |= bit
+            mask, mark = self.player_mask, self.player
+        else:
+            self.oponent_mask |= bit
+            mask, mark = self.oponent_mask, self.oponent
+
+        for line in self.__lines[square]:
+            if mask & line == line:
+                self.winner = mark
+                return mark
+
+        # Check for tie
+        if self.moves_count == self.size * self.size:
+            self.winner = "tie"
+            return self.winner
+
+    def __mark(self, square):
+        if self.player_mask >> square & 1:
+            return self.player
+        if self.oponent_mask >> square & 1:
+            return self.oponent
+        return ""
+
+    def __str__(self):
+        n = self.size
+        string = "TABULEIRO:\n"
+        string += "     " + "    ".join(f"{j + 1:<2}" for j in range(n)) + "\n\n"
+
+        for i in range(n):
+            marks = [f"{self.__mark(i * n + j):<2}" for j in range(n)]
+            string += f"{i + 1:<5}" + " |  ".join(marks) + "\n"
+            if i < n - 1:
+                string += "    " + "-----" * n + "\n"
+
+        return string
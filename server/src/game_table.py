@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from itertools import count
+from random import shuffle
+from time import monotonic
+from src.game import TicTacToe
+
+
+class RelayGame:
+    # A game played through the server. The first player is X and the board
+    # is kept from its point of view, so the second player's moves are the
+    # "oponent" moves of TicTacToe. Slots keep a game, board included, to a
+    # few hundred bytes so the server can hold a large number of them.
+    __slots__ = ("id", "players", "board", "turn", "started", "moved_at")
+
+    def __init__(self, game_id, players, size=3, k=3):
+        self.id = game_id
+        self.players = players
+        self.started = False
+        self.board = TicTacToe("X", "O", size, k)
+        self.turn = 0
+        # Last time the game waited on a player, answering the invitation
+        # before it starts and moving after
+        self.moved_at = monotonic()
+
+    def start(self):
+        players = list(self.players)
+        shuffle(players)
+        self.players = tuple(players)
+        self.started = True
+
+    def opponent(self, username):
+        return self.players[1] if self.players[0] == username else self.players[0]
+
+    def mark(self, username):
+        return "X" if self.players[0] == username else "O"
+
+    def play(self, username, row, col):
+        if not self.started or self.players[self.turn] != username:
+            return "invalid"
+
+        if self.turn == 0:
+            result = self.board.play(row, col)
+        else:
+            result = self.board.update_oponent_move(row, col)
+
+        if result != "invalid":
+            self.turn ^= 1
+        return result
+
+    def winner(self, result):
+        if result == "tie":
+            return "tie"
+        return self.players[0] if result == "X" else self.players[1]
+
+
+class GameTable:
+    # Relay games by id and by player. Not thread safe, the server only uses
+    # it while holding the presence lock, which also guards the state of the
+    # players involved.
+    #
+    # Games are kept ordered by their last move, so the ones a player stopped
+    # answering are all at the front and expiring them does not walk the
+    # games still being played.
+    #
+    # Ids are also the ones of the stored history, worker processes number
+    # their games from different first ids with a step of the worker count.
+
+    def __init__(self, first_id=1, step=1):
+        self.__ids = count(first_id, step)
+        self.__games = OrderedDict()
+        self.__players = {}
+
+    def __len__(self):
+        return len(self.__games)
+
+    def create(self, players, size=3, k=3):
+        game = RelayGame(next(self.__ids), players, size, k)
+        self.__games[game.id] = game
+        for username in players:
+            self.__players[username] = game
+        return game
+
+    def get(self, game_id):
+        return self.__games.get(game_id)
+
+    def of(self, username):
+        return self.__players.get(username)
+
+    def start(self, game):
+        game.start()
+        self.__touch(game)
+
+    def play(self, game, username, row, col):
+        result = game.play(username, row, col)
+        if result != "invalid":
+            self.__touch(game)
+        return result
+
+    def expired(self, timeout):
+        # Games waiting on the same player for longer than timeout, oldest
+        # first
+        deadline = monotonic() - timeout
+        games = []
+        for game in self.__games.values():
+            if game.moved_at > deadline:
+                break
+            games.append(game)
+        return games
+
+    def remove(self, game):
+        self.__games.pop(game.id, None)
+        for username in game.players:
+            if self.__players.get(username) is game:
+                del self.__players[username]
+
+    def __touch(self, game):
+        game.moved_at = monotonic()
+        self.__games.move_to_end(game.id)
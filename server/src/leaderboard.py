@@ -0,0 +1,145 @@
+from bisect import bisect_left, insort
+from threading import Lock
+
+
+class Leaderboard:
+    # Users are kept in a list sorted by (-points, username), so a page of the
+    # ranking is a slice and the position of a user is a binary search.
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__ranking = []
+        self.__users = {}
+
+    def load(self, users):
+        with self.__lock:
+            self.__users = {}
+            for username, wins, loses, ties in users or []:
+                self.__users[username] = {
+                    "username": username,
+                    "wins": wins or 0,
+                    "ties": ties or 0,
+                    "loses": loses or 0,
+                    "points": 2 * (wins or 0) + (ties or 0),
+                }
+            self.__ranking = sorted(self.__key(user) for user in self.__users.values())
+
+    def add_user(self, username):
+        with self.__lock:
+            if username in self.__users:
+                return
+
+            user = {"username": username, "wins": 0, "ties": 0, "loses": 0, "points": 0}
+            self.__users[username] = user
+            insort(self.__ranking, self.__key(user))
+
+    def record(self, username, game_status):
+        with self.__lock:
+            if (user := self.__users.get(username)) is None:
+                return
+
+            del self.__ranking[bisect_left(self.__ranking, self.__key(user))]
+
+            if game_status == "win":
+                user["wins"] += 1
+                user["points"] += 2
+            elif game_status == "tie":
+                user["ties"] += 1
+                user["points"] += 1
+            else:
+                user["loses"] += 1
+
+            insort(self.__ranking, self.__key(user))
+
+    def points(self, username):
+        with self.__lock:
+            user = self.__users.get(username)
+            return user["points"] if user else None
+
+    def rank(self, username):
+        with self.__lock:
+            if (user := self.__users.get(username)) is None:
+                return None
+            return bisect_left(self.__ranking, self.__key(user))
+
+    def page(self, offset=0, limit=None):
+        with self.__lock:
+            end = len(self.__ranking) if limit is None else offset + limit
+            return self.__entries(offset, end), len(self.__ranking)
+
+    def around(self, username, limit=10):
+        with self.__lock:
+            if (user := self.__users.get(username)) is None:
+                return [], len(self.__ranking)
+
+            position = bisect_left(self.__ranking, self.__key(user))
+            offset = max(position - limit // 2, 0)
+            return self.__entries(offset, offset + limit), len(self.__ranking)
+
+    def __entries(self, start, end):
+        return [
+            {**self.__users[username], "position": position + 1}
+            for position, (_, username) in enumerate(
+                self.__ranking[start:end], start=start
+            )
+        ]
+
+    def __key(self, user):
+        return (-user["points"], user["username"])
+
+
+class SQLLeaderboard:
+    # Same interface as Leaderboard, but the ranking is read straight from the
+    # points index of the users table, so nothing is kept in memory but the
+    # number of users, counted once instead of on every request.
+
+    def __init__(self, db):
+        self.db = db
+        self.__lock = Lock()
+        self.__total = db.count_users()
+
+    def add_user(self, username):
+        with self.__lock:
+            self.__total += 1
+
+    def refresh_total(self):
+        # Other worker processes add users too, their count is only seen here
+        total = self.db.count_users()
+        with self.__lock:
+            self.__total = total
+
+    def record(self, username, game_status):
+        pass
+
+    def points(self, username):
+        return self.db.get_user_points(username)
+
+    def rank(self, username):
+        return self.db.get_user_rank(username)
+
+    def page(self, offset=0, limit=None):
+        users = self.db.get_top_users(limit, offset)
+        return self.__entries(users, offset), self.__total
+
+    def around(self, username, limit=10):
+        if (position := self.db.get_user_rank(username)) is None:
+            return [], self.__total
+
+        offset = max(position - limit // 2, 0)
+        users = self.db.get_top_users(limit, offset)
+        return self.__entries(users, offset), self.__total
+
+    def __entries(self, users, offset):
+        return [
+            {
+                "username": username,
+                "wins": wins,
+                "ties": ties,
+                "loses": loses,
+                "points": points,
+                "position": position + 1,
+            }
+            for position, (username, wins, loses, ties, points) in enumerate(
+                users, start=offset
+            )
+        ]
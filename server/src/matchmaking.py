@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class MatchmakingQueue:
+    # Players waiting for an opponent, oldest first. Without a band any two
+    # players are paired. With a band, players are bucketed by points // band,
+    # so a newcomer only looks at the oldest players of its own bucket and the
+    # two next to it. The accepted difference widens the longer a player
+    # waits, up to everything those neighbouring buckets hold.
+    #
+    # Not thread safe, the server only touches it while holding the presence
+    # lock, which is also what makes pairing and the state change atomic.
+
+    def __init__(self, band=None, widen_after=10.0):
+        self.band = band
+        self.widen_after = widen_after
+
+        self.__buckets = {}
+        self.__players = {}
+
+    def __len__(self):
+        return len(self.__players)
+
+    def __contains__(self, username):
+        return username in self.__players
+
+    def join(self, username, points=0):
+        if username in self.__players:
+            return None
+
+        now = monotonic()
+        if (opponent := self.__find_opponent(points, now)) is not None:
+            self.leave(opponent)
+            return opponent
+
+        bucket = self.__bucket(points)
+        self.__players[username] = (bucket, points, now)
+        self.__buckets.setdefault(bucket, OrderedDict())[username] = (points, now)
+        return None
+
+    def leave(self, username):
+        if (player := self.__players.pop(username, None)) is None:
+            return False
+
+        bucket = self.__buckets[player[0]]
+        del bucket[username]
+        if not bucket:
+            del self.__buckets[player[0]]
+        return True
+
+    def __find_opponent(self, points, now):
+        if self.band is None:
+            bucket = self.__buckets.get(0)
+            return next(iter(bucket)) if bucket else None
+
+        bucket = self.__bucket(points)
+        opponent, oldest = None, now
+
+        for neighbour in (bucket - 1, bucket, bucket + 1):
+            for username, (opponent_points, joined) in self.__buckets.get(
+                neighbour, {}
+            ).items():
+                # Buckets are in arrival order, the first acceptable player of
+                # each one is the oldest it can offer
+                if joined >= oldest:
+                    break
+                if abs(opponent_points - points) <= self.__allowed(joined, now):
+                    opponent, oldest = username, joined
+                    break
+
+        return opponent
+
+    def __allowed(self, joined, now):
+        return self.band * (1 + int((now - joined) // self.widen_after))
+
+    def __bucket(self, points):
+        return 0 if self.band is None else points // self.band
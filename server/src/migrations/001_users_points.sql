@@ -0,0 +1,5 @@
+ALTER TABLE users ADD COLUMN points INTEGER GENERATED ALWAYS AS (
+    2 * IFNULL(win_count, 0) + IFNULL(tie_count, 0)
+) VIRTUAL;
+
+CREATE INDEX IF NOT EXISTS users_points ON users(points DESC, username);
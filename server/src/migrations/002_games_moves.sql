@@ -0,0 +1,28 @@
+-- Relay games and their moves. Game ids come from the server, moves are
+-- numbered from 1 in each game and odd moves are X, the first player's.
+CREATE TABLE IF NOT EXISTS games(
+    id INTEGER PRIMARY KEY,
+    player_one TEXT NOT NULL,
+    player_two TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    k INTEGER NOT NULL,
+    started_at TEXT NOT NULL,
+    ended_at TEXT,
+    end_status TEXT,
+    winner TEXT
+);
+
+CREATE INDEX IF NOT EXISTS games_player_one ON games(player_one, started_at);
+CREATE INDEX IF NOT EXISTS games_player_two ON games(player_two, started_at);
+CREATE INDEX IF NOT EXISTS games_started_at ON games(started_at);
+
+-- Clustered on the primary key, so the moves of a game are stored together
+-- and a replay reads them in order
+CREATE TABLE IF NOT EXISTS moves(
+    game_id INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    played_at TEXT NOT NULL,
+    PRIMARY KEY (game_id, number)
+) WITHOUT ROWID;
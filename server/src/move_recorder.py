@@ -0,0 +1,48 @@
+from datetime import datetime
+from src.batch_writer import BatchWriter
+
+
+class MoveRecorder:
+    # History of the relay games. Handlers only queue what happened, the
+    # batch writer thread stores it, a whole batch in one transaction, so a
+    # move does not wait for the database.
+
+    def __init__(self, storage, batch_size=256, flush_interval=1.0):
+        self.__storage = storage
+        self.__writer = BatchWriter(self.__flush, batch_size, flush_interval)
+
+    def start(self):
+        self.__writer.start()
+
+    def stop(self):
+        self.__writer.stop()
+
+    def game_started(self, game):
+        player_one, player_two = game.players
+        self.__writer.write(
+            (
+                "game",
+                (
+                    game.id,
+                    player_one,
+                    player_two,
+                    game.board.size,
+                    game.board.k,
+                    datetime.utcnow(),
+                ),
+            )
+        )
+
+    def move(self, game, row, col):
+        number = game.board.moves_count
+        self.__writer.write(("move", (game.id, number, row, col, datetime.utcnow())))
+
+    def game_ended(self, game, winner, end_status):
+        self.__writer.write(("end", (datetime.utcnow(), end_status, winner, game.id)))
+
+    def __flush(self, batch):
+        rows = {"game": [], "move": [], "end": []}
+        for kind, row in batch:
+            rows[kind].append(row)
+
+        self.__storage.insert_game_history(rows["game"], rows["move"], rows["end"])
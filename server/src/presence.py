@@ -0,0 +1,140 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from itertools import takewhile
+from threading import RLock
+
+
+class PresenceStore:
+    # Logged users as {username: [ip, listen_port, state]}. Every change bumps
+    # the version and is kept in a bounded history, so clients that already
+    # hold a snapshot only need the changes made after their version.
+    #
+    # Usernames are also indexed in sorted lists, one with everybody and one
+    # per state, so filtered, prefixed and paginated listings are a binary
+    # search plus the page itself.
+
+    def __init__(self, history=4096, on_change=None):
+        self.lock = RLock()
+        self.version = 0
+        self.on_change = on_change
+
+        self.__users = {}
+        self.__changes = deque(maxlen=history)
+        self.__usernames = []
+        self.__by_state = {}
+
+    def get(self, username):
+        with self.lock:
+            if (player := self.__users.get(username)) is None:
+                return None
+            return list(player)
+
+    def add(self, username, ip, port, state="IDLE"):
+        with self.lock:
+            if (player := self.__users.get(username)) is not None:
+                self.__unindex(username, player[2])
+            else:
+                insort(self.__usernames, username)
+
+            self.__users[username] = [ip, port, state]
+            insort(self.__by_state.setdefault(state, []), username)
+            self.__changed(username)
+
+    def set_state(self, username, state):
+        with self.lock:
+            if (player := self.__users.get(username)) is None or player[2] == state:
+                return
+
+            self.__unindex(username, player[2])
+            player[2] = state
+            insort(self.__by_state.setdefault(state, []), username)
+            self.__changed(username)
+
+    def transition(self, usernames, from_state, to_state):
+        # Moves all the players at once, and only if every one of them is
+        # still in from_state
+        with self.lock:
+            for username in usernames:
+                if (player := self.__users.get(username)) is None:
+                    return False
+                if player[2] != from_state:
+                    return False
+
+            for username in usernames:
+                self.set_state(username, to_state)
+            return True
+
+    def remove(self, username):
+        with self.lock:
+            if (player := self.__users.pop(username, None)) is None:
+                return False
+
+            self.__unindex(username, player[2])
+            del self.__usernames[bisect_left(self.__usernames, username)]
+            self.__changed(username)
+            return True
+
+    def query(self, state=None, prefix=None, cursor=None, limit=50):
+        with self.lock:
+            usernames = (
+                self.__usernames if state is None else self.__by_state.get(state, [])
+            )
+
+            if cursor is not None:
+                start = bisect_right(usernames, cursor)
+            else:
+                start = bisect_left(usernames, prefix or "")
+
+            # One extra entry tells whether there is another page
+            page = usernames[start : start + limit + 1]
+            if prefix:
+                page = list(takewhile(lambda name: name.startswith(prefix), page))
+
+            next_cursor = page[limit - 1] if len(page) > limit else None
+            players = {
+                username: list(self.__users[username]) for username in page[:limit]
+            }
+
+            return self.version, players, next_cursor
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, {
+                username: list(player) for username, player in self.__users.items()
+            }
+
+    def changes_since(self, version, compact=True):
+        with self.lock:
+            if version == self.version:
+                return self.version, []
+
+            # The history no longer reaches back to that version
+            if not self.__changes or self.__changes[0]["version"] > version + 1:
+                return self.version, None
+
+            changes = [
+                change for change in self.__changes if change["version"] > version
+            ]
+
+            # Past this point a full snapshot is the smaller answer
+            if compact and len(changes) > len(self.__users):
+                return self.version, None
+
+            return self.version, changes
+
+    def __unindex(self, username, state):
+        usernames = self.__by_state[state]
+        del usernames[bisect_left(usernames, username)]
+
+    def __changed(self, username):
+        self.version += 1
+        player = self.__users.get(username)
+        change = {
+            "version": self.version,
+            "username": username,
+            "player": list(player) if player else None,
+        }
+        self.__changes.append(change)
+
+        if self.on_change:
+            self.on_change(change)
@@ -0,0 +1,53 @@
+from struct import Struct
+
+# Every packet on the wire is a 4 byte big-endian length followed by the
+# payload, so packets can be bigger than a single recv and several packets
+# coalesced by TCP can be split apart again.
+HEADER = Struct("!I")
+MAX_PACKET_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_packet(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+class PacketDecoder:
+    def __init__(self, bufflen=1024, max_packet_size=MAX_PACKET_SIZE):
+        self.max_packet_size = max_packet_size
+
+        self.__chunk = memoryview(bytearray(bufflen))
+        self.__buffer = bytearray()
+
+    def receive(self, connection):
+        received = connection.recv_into(self.__chunk)
+
+        if not received:
+            return None
+
+        return self.feed(self.__chunk[:received])
+
+    def feed(self, data):
+        self.__buffer += data
+        packets = []
+        offset = 0
+
+        while len(self.__buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.__buffer, offset)
+
+            if length > self.max_packet_size:
+                raise ProtocolError(f"Packet of {length} bytes exceeds the size limit")
+
+            end = offset + HEADER.size + length
+            if len(self.__buffer) < end:
+                break
+
+            packets.append(bytes(self.__buffer[offset + HEADER.size : end]))
+            offset = end
+
+        del self.__buffer[:offset]
+
+        return packets
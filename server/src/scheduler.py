@@ -0,0 +1,57 @@
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Condition
+from time import monotonic
+from traceback import print_exception
+
+
+class Scheduler(Thread):
+    # Periodic server jobs share this single thread. The next run of every job
+    # is kept in a heap ordered by deadline, so the thread only wakes up when
+    # the earliest one is due or a new job is added.
+
+    def __init__(self):
+        self.__condition = Condition()
+        self.__jobs = []
+        self.__sequence = count()
+        self.__is_running = True
+
+        Thread.__init__(self, daemon=True)
+
+    def every(self, interval, job):
+        with self.__condition:
+            heappush(
+                self.__jobs,
+                (monotonic() + interval, next(self.__sequence), interval, job),
+            )
+            self.__condition.notify()
+
+    def stop(self):
+        with self.__condition:
+            self.__is_running = False
+            self.__condition.notify()
+
+    def run(self):
+        while True:
+            with self.__condition:
+                while self.__is_running and (
+                    not self.__jobs or self.__jobs[0][0] > monotonic()
+                ):
+                    self.__condition.wait(
+                        self.__jobs[0][0] - monotonic() if self.__jobs else None
+                    )
+
+                if not self.__is_running:
+                    return
+
+                deadline, _, interval, job = heappop(self.__jobs)
+                # A late run does not make the missed ones pile up
+                deadline += interval
+                if deadline <= monotonic():
+                    deadline = monotonic() + interval
+                heappush(self.__jobs, (deadline, next(self.__sequence), interval, job))
+
+            try:
+                job()
+            except Exception as error:
+                print_exception(error)
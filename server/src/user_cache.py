@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class UserCache:
+    # LRU cache with a time to live in front of Storage.get_user. Entries are
+    # dropped whenever the user is written, and a lookup that raced with such
+    # a write does not put its stale result back.
+
+    def __init__(self, db, max_size=10000, ttl=300):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = Lock()
+        self.__users = OrderedDict()
+        self.__generation = 0
+
+    def get_user(self, username):
+        with self.__lock:
+            if (entry := self.__users.get(username)) is not None:
+                expires_at, user = entry
+                if expires_at > monotonic():
+                    self.__users.move_to_end(username)
+                    self.hits += 1
+                    return user
+                del self.__users[username]
+
+            self.misses += 1
+            generation = self.__generation
+
+        user = self.db.get_user(username)
+
+        if user is not None:
+            with self.__lock:
+                if generation == self.__generation:
+                    self.__users[username] = (monotonic() + self.ttl, user)
+                    self.__users.move_to_end(username)
+                    while len(self.__users) > self.max_size:
+                        self.__users.popitem(last=False)
+
+        return user
+
+    def invalidate(self, username):
+        with self.__lock:
+            self.__generation += 1
+            self.__users.pop(username, None)
+
+    def stats(self):
+        with self.__lock:
+            return {"size": len(self.__users), "hits": self.hits, "misses": self.misses}